@@ -0,0 +1,496 @@
+from ryu.app.wsgi import ControllerBase, WSGIApplication, route
+from ryu.lib import hub
+from webob import Response
+import sqlite3
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from controller_v3 import DynamicFlowSwitch
+from validacion import validar_regla, validar_timeout
+from consultas import TABLAS_ESTADISTICAS, consultar_logs, reglas_inactivas, tasas_regla
+
+# Name under which the application instance is passed to the REST controller
+REST_APP_INSTANCE = "dynamic_flow_switch_app"
+
+# Dashboard page, served at / as server.py does
+INDEX_HTML = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "templates", "index.html")
+
+# Columns accepted by the modify endpoint, as in server.py
+COLUMNAS_VALIDAS = [
+    "dpid", "priority", "eth_type", "ip_proto", "ipv4_src", "ipv4_dst",
+    "tcp_src", "tcp_dst", "in_port", "actions", "idle_timeout", "hard_timeout"
+]
+COLUMNAS_ENTERAS = ["dpid", "priority", "eth_type", "ip_proto", "tcp_src", "tcp_dst", "in_port"]
+
+
+def respuesta_json(data, status=200):
+    """Build a JSON response that the dashboard can read from another origin."""
+    headers = {
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
+        "Access-Control-Allow-Headers": "Content-Type, X-Correlation-ID",
+        "Access-Control-Expose-Headers": "X-Correlation-ID"
+    }
+    if isinstance(data, dict) and data.get("correlation_id"):
+        headers["X-Correlation-ID"] = data["correlation_id"]
+    return Response(
+        status=status,
+        content_type="application/json",
+        charset="utf-8",
+        body=json.dumps(data).encode("utf-8"),
+        headers=headers
+    )
+
+
+def parametro_entero(req, nombre, defecto=None):
+    """Return a query parameter as an int, or the default if missing or invalid (like Flask's type=int)."""
+    try:
+        return int(req.GET[nombre])
+    except (KeyError, ValueError):
+        return defecto
+
+
+def obtener_correlation_id(req):
+    """Return the correlation ID of a write, taken from X-Correlation-ID or generated."""
+    return req.headers.get("X-Correlation-ID") or uuid.uuid4().hex
+
+
+class EmbeddedFlowSwitch(DynamicFlowSwitch):
+    """
+    DynamicFlowSwitch serving the rule API from inside the Ryu process.
+    The in-memory rules are the source of truth: REST writes are applied to
+    the switches directly and persisted to SQLite in the background, so the
+    rules table is not polled. Only the writes server.py makes to the same
+    database (template edits and snapshot rollbacks) are picked up from it.
+    """
+    _CONTEXTS = {'wsgi': WSGIApplication}
+
+    def __init__(self, *args, **kwargs):
+        super(EmbeddedFlowSwitch, self).__init__(*args, **kwargs)
+        # Load the current rules once; from now on they are kept in memory
+        self.db_rules = DynamicFlowSwitch.obtener_reglas_desde_db(self)
+        # Templates are loaded once and then reloaded by monitorizar_reglas
+        self.db_plantillas = self.obtener_plantillas_desde_db() or {}
+        # Changes waiting to be pushed to the switches, in arrival order
+        self.cola_cambios = hub.Queue()
+        # (rule_id, SQL statement, parameters) waiting to be written to the database
+        self.cola_persistencia = hub.Queue()
+        self.apply_thread = hub.spawn(self.aplicar_cambios_pendientes)
+        self.persist_thread = hub.spawn(self.persistir_cambios)
+
+        wsgi = kwargs['wsgi']
+        wsgi.register(ReglasRestController, {REST_APP_INSTANCE: self})
+        self.logger.info("Embedded REST API enabled.")
+
+    def monitorizar_reglas(self):
+        """
+        Pick up the writes server.py makes to the database: template changes,
+        and snapshot rollbacks, which leave a marker in `restauraciones`.
+        Rule writes made through this API reconcile directly.
+        """
+        while self.running:
+            try:
+                nuevas_plantillas = self.obtener_plantillas_desde_db()
+                if nuevas_plantillas is not None:
+                    for cambio in self.comparar_plantillas(self.db_plantillas, nuevas_plantillas):
+                        self.logger.info(f"Change detected for template {cambio['template_id']}: {cambio['campo']}.")
+                        self.aplicar_plantilla(cambio)
+                    self.db_plantillas = nuevas_plantillas
+                # Writes still waiting to be persisted would look reverted in the database
+                if self.cola_persistencia.empty():
+                    self.recargar_restauraciones()
+            except sqlite3.Error as e:
+                self.logger.warning(f"SQLite error: {e}.")
+            except Exception as e:
+                self.logger.error(f"Monitoring error: {e}.")
+            hub.sleep(self.monitor_interval)
+
+    def recargar_restauraciones(self):
+        """
+        If a snapshot was rolled back, reload the rules from the database and
+        queue the difference as a single batch, as DynamicFlowSwitch does.
+        """
+        conn = self.obtener_conexion_bd()
+        try:
+            restauraciones = [fila[0] for fila in conn.execute("SELECT correlation_id FROM restauraciones")]
+        finally:
+            conn.close()
+        if not restauraciones:
+            return
+
+        nuevas_db = DynamicFlowSwitch.obtener_reglas_desde_db(self)
+        t_deteccion = time.time()
+        cambios = self.comparar_reglas(self.db_rules, nuevas_db)
+        t_diff = time.time()
+        if cambios:
+            eliminaciones = self.obtener_trazas_eliminacion()
+            self.db_rules = nuevas_db
+            self.cola_cambios.put({"lote": (cambios, nuevas_db, eliminaciones, t_deteccion, t_diff)})
+            self.logger.info(f"Snapshot rollback detected: {len(cambios)} rule changes queued.")
+
+        conn = self.obtener_conexion_bd()
+        try:
+            conn.execute(f"DELETE FROM restauraciones WHERE correlation_id IN ({', '.join('?' * len(restauraciones))})",
+                         restauraciones)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def obtener_reglas_desde_db(self):
+        """
+        Return the in-memory rules, which may be ahead of the database.
+        """
+        return {dpid: dict(reglas) for dpid, reglas in self.db_rules.items()}
+
+    def buscar_regla(self, rule_id):
+        """
+        Return the rule with the given rule_id from any switch, or None.
+        """
+        for reglas in self.db_rules.values():
+            if rule_id in reglas:
+                return reglas[rule_id]
+        return None
+
+    def registrar_cambio(self, regla_antigua, regla_nueva, sql, params, correlation_id=None, escritura=None):
+        """
+        Replace a rule in memory, queue the switch changes it produces and
+        queue its persistence to the database.
+        """
+        self._reemplazar_regla(regla_antigua, regla_nueva, correlation_id, escritura)
+        rule_id = (regla_nueva or regla_antigua)["rule_id"]
+        self.cola_persistencia.put((rule_id, sql, params))
+
+    def _reemplazar_regla(self, regla_antigua, regla_nueva, correlation_id=None, escritura=None):
+        """
+        Replace a rule in memory and queue the switch changes it produces.
+        """
+        antiguas = {}
+        nuevas = {}
+        if regla_antigua:
+            antiguas.setdefault(regla_antigua["dpid"], {})[regla_antigua["rule_id"]] = regla_antigua
+            del self.db_rules[regla_antigua["dpid"]][regla_antigua["rule_id"]]
+        if regla_nueva:
+            nuevas.setdefault(regla_nueva["dpid"], {})[regla_nueva["rule_id"]] = regla_nueva
+            self.db_rules.setdefault(regla_nueva["dpid"], {})[regla_nueva["rule_id"]] = regla_nueva
+
+        cambios = self.comparar_reglas(antiguas, nuevas)
+        t_diff = time.time()
+        for cambio in cambios:
+            # There is no polling: the change is detected when it is written
+            cambio["traza"] = self._nueva_traza(correlation_id, escritura, escritura, t_diff)
+            self.cola_cambios.put(cambio)
+
+    def aplicar_cambios_pendientes(self):
+        """
+        Push queued changes to the switches one at a time, so the REST
+        handlers do not wait for the delete/sleep/add sequence.
+        """
+        while self.running:
+            cambio = self.cola_cambios.get()
+            if "lote" in cambio:
+                try:
+                    self.aplicar_cambios_en_lote(*cambio["lote"])
+                except Exception as e:
+                    self.logger.error(f"Error applying rollback batch: {e}")
+                continue
+            self.logger.info(f"Change requested on switch {cambio['dpid']} for rule {cambio['rule_id']}: {cambio['campo']}.")
+            try:
+                self.aplicar_cambios(cambio["dpid"], cambio["rule_id"], cambio["campo"],
+                                     cambio.get("valor_antiguo"), cambio.get("valor_nuevo"),
+                                     traza=cambio.get("traza"))
+            except Exception as e:
+                self.logger.error(f"Error applying change to rule {cambio['rule_id']}: {e}")
+
+    def persistir_cambios(self):
+        """
+        Write queued statements to SQLite, grouping whatever is pending
+        into a single transaction. Each statement runs in its own savepoint,
+        so a rejected write only affects its own rule.
+        """
+        while self.running:
+            pendientes = [self.cola_persistencia.get()]
+            while not self.cola_persistencia.empty():
+                pendientes.append(self.cola_persistencia.get())
+            fallidas = set()
+            conn = self.obtener_conexion_bd()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN")
+                for rule_id, sql, params in pendientes:
+                    cursor.execute("SAVEPOINT cambio")
+                    try:
+                        cursor.execute(sql, params)
+                    except sqlite3.Error as e:
+                        cursor.execute("ROLLBACK TO cambio")
+                        fallidas.add(rule_id)
+                        self.logger.error(f"Error persisting change to rule {rule_id}: {e}")
+                    cursor.execute("RELEASE cambio")
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                fallidas.update(rule_id for rule_id, _, _ in pendientes)
+                self.logger.error(f"Error persisting {len(pendientes)} rule changes: {e}")
+            finally:
+                conn.close()
+            if fallidas:
+                self.resincronizar_reglas(fallidas)
+
+    def resincronizar_reglas(self, rule_ids):
+        """
+        Bring rules whose write failed back to what the database holds,
+        in memory and on the switches.
+        """
+        conn = self.obtener_conexion_bd()
+        try:
+            filas = conn.execute(
+                "SELECT rule_id, dpid, priority, eth_type, ip_proto, ipv4_src, ipv4_dst, tcp_src, tcp_dst, in_port, actions, "
+                "idle_timeout, hard_timeout, correlation_id, updated_at FROM reglas "
+                f"WHERE rule_id IN ({', '.join('?' * len(rule_ids))})", list(rule_ids)
+            ).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(f"Error reloading rules {sorted(rule_ids)}: {e}")
+            return
+        finally:
+            conn.close()
+
+        guardadas = {fila[0]: self._construir_regla(*fila) for fila in filas}
+        for rule_id in rule_ids:
+            regla_memoria = self.buscar_regla(rule_id)
+            regla_db = guardadas.get(rule_id)
+            if regla_memoria is None and regla_db is None:
+                continue
+            self.logger.warning(f"Rule {rule_id} could not be saved. Reverting it to the database state.")
+            self._reemplazar_regla(regla_memoria, regla_db, escritura=time.time())
+
+
+class ReglasRestController(ControllerBase):
+    """
+    Dashboard, rule CRUD, log and flow statistics API with the same paths as
+    server.py, so the dashboard works unchanged. Templates, snapshots, switch
+    tags and the log archive are only served by server.py.
+    """
+
+    def __init__(self, req, link, data, **config):
+        super(ReglasRestController, self).__init__(req, link, data, **config)
+        self.app = data[REST_APP_INSTANCE]
+
+    @staticmethod
+    def _serializar(regla):
+        return {
+            "dpid": regla["dpid"],
+            "rule_id": regla["rule_id"],
+            "priority": regla["priority"],
+            "eth_type": regla["eth_type"],
+            "ip_proto": regla["ip_proto"],
+            "ipv4_src": regla["ipv4_src"],
+            "ipv4_dst": regla["ipv4_dst"],
+            "tcp_src": regla["tcp_src"],
+            "tcp_dst": regla["tcp_dst"],
+            "in_port": regla["in_port"],
+            "actions": regla["actions"],
+            "idle_timeout": regla["idle_timeout"],
+            "hard_timeout": regla["hard_timeout"]
+        }
+
+    @route('reglas', '/', methods=['GET'])
+    def index(self, req, **kwargs):
+        """Serve the dashboard page."""
+        with open(INDEX_HTML, "rb") as f:
+            return Response(content_type="text/html", charset="utf-8", body=f.read())
+
+    @route('reglas', '/reglas', methods=['GET'])
+    def obtener_reglas(self, req, **kwargs):
+        """Retrieve all rules."""
+        reglas_lista = [self._serializar(regla)
+                        for reglas in self.app.db_rules.values()
+                        for regla in reglas.values()]
+        if not reglas_lista:
+            return respuesta_json({"message": "No rules registered."})
+        return respuesta_json({"switches": reglas_lista})
+
+    @route('reglas', '/reglas/buscar/{rule_id}', methods=['GET'], requirements={'rule_id': r'\d+'})
+    def obtener_regla(self, req, rule_id, **kwargs):
+        """Retrieve a specific rule by its Rule ID."""
+        regla = self.app.buscar_regla(int(rule_id))
+        if not regla:
+            return respuesta_json({'error': 'Rule not found'}, 404)
+        return respuesta_json(self._serializar(regla))
+
+    @route('reglas', '/reglas/max_rule_id', methods=['GET'])
+    def obtener_max_rule_id(self, req, **kwargs):
+        """Retrieve the next available rule_id (maximum + 1)."""
+        ids = [rule_id for reglas in self.app.db_rules.values() for rule_id in reglas]
+        return respuesta_json({"next_rule_id": max(ids) + 1 if ids else 1})
+
+    @route('reglas', '/reglas/{dpid}', methods=['POST'], requirements={'dpid': r'\d+'})
+    def agregar_regla(self, req, dpid, **kwargs):
+        """Add a new rule. If no rule_id is given, the next free one is assigned."""
+        try:
+            data = req.json
+            if not all(k in data for k in ["eth_type", "priority", "actions"]):
+                return respuesta_json({"error": "Missing required fields."}, 400)
+            if data.get("rule_id") is not None:
+                rule_id = int(data["rule_id"])
+                if self.app.buscar_regla(rule_id):
+                    return respuesta_json({"error": "A rule with this ID already exists."}, 400)
+            else:
+                ids = [r for reglas in self.app.db_rules.values() for r in reglas]
+                rule_id = max(ids) + 1 if ids else 1
+
+            valores = (
+                int(dpid),
+                rule_id,
+                int(data["priority"]),
+                int(data["eth_type"]),
+                int(data.get("ip_proto", 0)),
+                data.get("ipv4_src"),
+                data.get("ipv4_dst"),
+                int(data.get("tcp_src", 0)) if data.get("tcp_src") else None,
+                int(data.get("tcp_dst", 0)) if data.get("tcp_dst") else None,
+                int(data.get("in_port", 0)) if data.get("in_port") else None,
+                json.dumps(data["actions"]),
+                validar_timeout(data.get("idle_timeout")),
+                validar_timeout(data.get("hard_timeout"))
+            )
+            # Reject what the database would, before the flow reaches the switch
+            validar_regla(dict(zip(["dpid", "rule_id"] + COLUMNAS_VALIDAS[1:], valores)))
+        except (TypeError, ValueError) as e:
+            return respuesta_json({"error": str(e)}, 400)
+
+        correlation_id = obtener_correlation_id(req)
+        escritura = time.time()
+        valores += (correlation_id, escritura)
+        dpid, rule_id, priority, eth_type, ip_proto, ipv4_src, ipv4_dst, \
+            tcp_src, tcp_dst, in_port, actions, idle_timeout, hard_timeout, _, _ = valores
+        regla = self.app._construir_regla(rule_id, dpid, priority, eth_type, ip_proto, ipv4_src, ipv4_dst,
+                                          tcp_src, tcp_dst, in_port, actions, idle_timeout, hard_timeout,
+                                          correlation_id, escritura)
+        self.app.registrar_cambio(None, regla, """
+            INSERT INTO reglas (dpid, rule_id, priority, eth_type, ip_proto, ipv4_src, ipv4_dst, tcp_src, tcp_dst, in_port, actions,
+                                idle_timeout, hard_timeout, correlation_id, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, valores, correlation_id, escritura)
+        return respuesta_json({"message": "Rule added successfully", "rule_id": rule_id,
+                               "correlation_id": correlation_id})
+
+    @route('reglas', '/reglas/modificar/{rule_id}', methods=['PUT'], requirements={'rule_id': r'\d+'})
+    def modificar_regla(self, req, rule_id, **kwargs):
+        """Update an existing rule."""
+        rule_id = int(rule_id)
+        try:
+            data = req.json
+        except ValueError:
+            data = None
+        if not data:
+            return respuesta_json({"error": "No data provided for modification"}, 400)
+
+        regla = self.app.buscar_regla(rule_id)
+        if not regla:
+            return respuesta_json({"error": "Rule not found"}, 404)
+
+        columnas = {k: regla[k] for k in COLUMNAS_VALIDAS}
+        fields_to_update = []
+        values = []
+        try:
+            for key, value in data.items():
+                if key not in COLUMNAS_VALIDAS:
+                    continue
+                if key in ("idle_timeout", "hard_timeout"):
+                    value = validar_timeout(value)
+                elif key in COLUMNAS_ENTERAS:
+                    # Same conversion SQLite applies to INTEGER columns; empty means unset
+                    value = int(value) if value not in (None, "") else None
+                columnas[key] = value
+                fields_to_update.append(f"{key} = ?")
+                values.append(json.dumps(value) if key == "actions" else value)
+            validar_regla(dict(columnas, rule_id=rule_id))
+        except (TypeError, ValueError) as e:
+            return respuesta_json({"error": str(e)}, 400)
+
+        if not fields_to_update:
+            return respuesta_json({"error": "No valid fields provided for update"}, 400)
+
+        correlation_id = obtener_correlation_id(req)
+        escritura = time.time()
+        nueva = self.app._construir_regla(rule_id, correlation_id=correlation_id, updated_at=escritura, **columnas)
+        fields_to_update += ["correlation_id = ?", "updated_at = ?"]
+        values += [correlation_id, escritura, rule_id]
+        self.app.registrar_cambio(regla, nueva,
+                                  f"UPDATE reglas SET {', '.join(fields_to_update)} WHERE rule_id = ?", values,
+                                  correlation_id, escritura)
+        return respuesta_json({"message": "Rule modified successfully", "rule_id": rule_id,
+                               "correlation_id": correlation_id})
+
+    @route('reglas', '/reglas/eliminar/{rule_id}', methods=['DELETE'], requirements={'rule_id': r'\d+'})
+    def eliminar_regla(self, req, rule_id, **kwargs):
+        """Delete a specific rule."""
+        rule_id = int(rule_id)
+        regla = self.app.buscar_regla(rule_id)
+        if not regla:
+            return respuesta_json({"error": "Rule not found"}, 404)
+        correlation_id = obtener_correlation_id(req)
+        self.app.registrar_cambio(regla, None, "DELETE FROM reglas WHERE rule_id = ?", (rule_id,),
+                                  correlation_id, time.time())
+        return respuesta_json({"message": "Rule deleted successfully", "rule_id": rule_id,
+                               "correlation_id": correlation_id})
+
+    @route('reglas', '/logs', methods=['GET'])
+    def obtener_logs(self, req, **kwargs):
+        """Retrieve change logs from the SQLite database, optionally filtered and limited."""
+        conn = self.app.obtener_conexion_bd()
+        try:
+            logs = consultar_logs(
+                conn.cursor(),
+                desde=req.GET.get("desde"),
+                hasta=req.GET.get("hasta"),
+                dpid=parametro_entero(req, "dpid"),
+                limite=parametro_entero(req, "limite")
+            )
+        except sqlite3.Error as e:
+            return respuesta_json({"error": f"Error fetching logs: {str(e)}"}, 500)
+        finally:
+            conn.close()
+
+        if not logs:
+            return respuesta_json({"message": "No log records."})
+        return respuesta_json(logs)
+
+    @route('reglas', '/estadisticas/{rule_id}', methods=['GET'], requirements={'rule_id': r'\d+'})
+    def obtener_estadisticas_regla(self, req, rule_id, **kwargs):
+        """Retrieve packet and byte rates of a rule from the flow statistics."""
+        resolucion = req.GET.get("resolucion", "1m")
+        if resolucion not in TABLAS_ESTADISTICAS:
+            return respuesta_json({"error": "Invalid resolution. Use raw, 1m or 1h."}, 400)
+        conn = self.app.obtener_conexion_bd()
+        try:
+            tasas = tasas_regla(conn.cursor(), int(rule_id), resolucion, parametro_entero(req, "desde"))
+        except sqlite3.Error as e:
+            return respuesta_json({"error": f"Error fetching statistics: {str(e)}"}, 500)
+        finally:
+            conn.close()
+
+        if tasas is None:
+            return respuesta_json({"message": "No statistics for this rule."})
+        return respuesta_json({"rule_id": int(rule_id), "resolucion": resolucion, "tasas": tasas})
+
+    @route('reglas', '/estadisticas/inactivas', methods=['GET'])
+    def obtener_reglas_inactivas(self, req, **kwargs):
+        """Retrieve the rules that matched no packets during the last 'ventana' seconds."""
+        ventana = parametro_entero(req, "ventana", 3600)
+        conn = self.app.obtener_conexion_bd()
+        try:
+            inactivas = reglas_inactivas(conn.cursor(), ventana)
+        except sqlite3.Error as e:
+            return respuesta_json({"error": f"Error fetching idle rules: {str(e)}"}, 500)
+        finally:
+            conn.close()
+        return respuesta_json({"ventana": ventana, "reglas": inactivas})
+
+    @route('reglas', '/{ruta:.*}', methods=['OPTIONS'])
+    def preflight(self, req, **kwargs):
+        """Answer CORS preflight requests from the dashboard."""
+        return respuesta_json({})
@@ -1,16 +1,83 @@
 from ryu.base import app_manager
 from ryu.controller import ofp_event
-from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
+from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER, DEAD_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
 from ryu.lib import hub
 import sqlite3
 import json
 import time
+import os
+import sys
+import cProfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models"))
+from archivar_logs import archivar_logs
+
+# Cookies of flows expanded from templates have the top bit set, so they
+# never collide with the cookie of a single-switch rule (its rule_id)
+COOKIE_PLANTILLA = 1 << 63
+
+# Statement used to insert rows in the 'logs' table
+SQL_INSERTAR_LOG = """
+    INSERT INTO logs (
+        dpid, 
+        rule_id, 
+        action, 
+        priority, 
+        eth_type, 
+        ip_proto, 
+        ipv4_src, 
+        ipv4_dst, 
+        tcp_src, 
+        tcp_dst, 
+        in_port, 
+        actions,
+        template_id,
+        correlation_id,
+        xid,
+        traza
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
 
 class Config:
     # Path to the SQLite database containing the rules
     db_path = "/home/juanes/enfa/reglas.db"
+    # Seconds between two flow statistics polls of the same switch
+    stats_interval = 30
+    # Number of buffered samples that triggers a write to the database
+    stats_batch_size = 500
+    # Retention (seconds) of each statistics resolution
+    stats_retention = {
+        "estadisticas_raw": 6 * 3600,
+        "estadisticas_1m": 7 * 24 * 3600,
+        "estadisticas_1h": 90 * 24 * 3600,
+    }
+    # Directory holding the compressed archive of old logs
+    logs_archive_dir = "/home/juanes/enfa/archivo_logs"
+    # Logs older than this many days, or beyond this many rows, are archived
+    logs_max_age_days = 30
+    logs_max_rows = 100000
+    # Seconds between two log retention runs
+    logs_retention_interval = 3600
+    # Share identical action lists between rules through OpenFlow group entries
+    use_group_tables = False
+    # Cycles with at least this many changes skip the per-rule delete/sleep/add
+    # path and send only the minimal FlowMods in one batch (rollbacks always do)
+    bulk_change_threshold = 50
+    # On reconnect, replay only the changes missed while a switch was offline if
+    # its flow table still matches (checked with a flow stats request); a switch
+    # that lost its flows gets every rule reinstalled. False always reinstalls
+    replay_on_reconnect = True
+    # Rules replayed per batch, and pause between batches, after a reconnect
+    replay_batch_size = 100
+    replay_batch_pause = 0.1
+    # Reconciliation cycles slower than this many seconds dump a cProfile file (None disables profiling).
+    # The profiler stays on while the cycle yields in hub.sleep, so time spent by other
+    # green threads (statistics, event handlers) during those sleeps is counted too
+    profile_slow_cycle_seconds = None
+    profile_dir = "/tmp/sdn_profiles"
 
 class DynamicFlowSwitch(app_manager.RyuApp):
     # Supported OpenFlow versions
@@ -24,6 +91,20 @@ class DynamicFlowSwitch(app_manager.RyuApp):
         self.installed_flows = {}
         # Dictionary to cache rules from the database
         self.db_rules = {}
+        # Dictionary to cache rule templates: template_id -> template data
+        self.db_plantillas = {}
+        # Template flows installed per template: template_id -> dpid -> (priority, match, actions)
+        self.plantillas_instaladas = {}
+        # Group entries per dpid: actions key -> {"group_id", "actions", "rules"}
+        self.grupos = {}
+        # Rules changed while their switch was offline: dpid -> set of rule_ids
+        self.cambios_pendientes = {}
+        # Flow table checks of reconnected switches: (datapath, request xid) -> cookies reported so far
+        self.verificaciones = {}
+        # Change traces waiting for a barrier reply: (datapath, barrier xid) -> trace
+        self.trazas_pendientes = {}
+        # Rules removed by the switch after a timeout, per dpid
+        self.reglas_expiradas = {}
         # Flag to control the monitoring thread
         self.running = True
         # Path to the database
@@ -33,15 +114,25 @@ class DynamicFlowSwitch(app_manager.RyuApp):
         self.monitor_interval = kwargs.get('monitor_interval', 10)
         # Start the monitoring thread
         self.monitor_thread = hub.spawn(self.monitorizar_reglas)
+        # Interval for polling flow statistics from every switch
+        self.stats_interval = kwargs.get('stats_interval', Config.stats_interval)
+        # Flow statistics samples waiting to be written to the database
+        self.stats_buffer = []
+        # Start the statistics collector thread
+        self.stats_thread = hub.spawn(self.recolectar_estadisticas)
+        # Start the log retention thread
+        self.retention_thread = hub.spawn(self.retener_logs)
 
     def obtener_conexion_bd(self):
         # Establish a connection to the SQLite database
         return sqlite3.connect(self.db_path)
 
-    def guardar_log_en_sqlite(self, regla, action="INSTALADA"):
+    def guardar_log_en_sqlite(self, regla, action="INSTALADA", traza=None):
         """
         Save a log entry in the 'logs' table for rule changes.
+        Returns the id of the new row, or None if it could not be saved.
         """
+        log_id = None
         try:
             conn = self.obtener_conexion_bd()
             cursor = conn.cursor()
@@ -57,23 +148,7 @@ class DynamicFlowSwitch(app_manager.RyuApp):
 
             # Insert the log entry into the 'logs' table
             self.logger.info(f"Inserting log for rule {regla.get('rule_id')} into the SQLite database...")
-            cursor.execute("""
-                INSERT INTO logs (
-                    dpid, 
-                    rule_id, 
-                    action, 
-                    priority, 
-                    eth_type, 
-                    ip_proto, 
-                    ipv4_src, 
-                    ipv4_dst, 
-                    tcp_src, 
-                    tcp_dst, 
-                    in_port, 
-                    actions
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
+            cursor.execute(SQL_INSERTAR_LOG, (
                 dpid,  
                 regla.get("rule_id"),
                 action,  
@@ -85,9 +160,14 @@ class DynamicFlowSwitch(app_manager.RyuApp):
                 regla.get("tcp_src"),
                 regla.get("tcp_dst"),
                 regla.get("in_port"),
-                actions_str
+                actions_str,
+                regla.get("template_id"),
+                traza["correlation_id"] if traza else None,
+                traza.get("xid") if traza else None,
+                json.dumps(self._resumir_traza(traza)) if traza else None
             ))
             conn.commit()
+            log_id = cursor.lastrowid
             self.logger.info(f"Log recorded for rule {regla.get('rule_id')}.")
 
         except sqlite3.Error as e:
@@ -98,6 +178,7 @@ class DynamicFlowSwitch(app_manager.RyuApp):
             self.logger.error(f"Validation error: {ve}")
         finally:
             conn.close()
+        return log_id
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
@@ -115,6 +196,28 @@ class DynamicFlowSwitch(app_manager.RyuApp):
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
         self.add_flow(datapath, 0, match, actions, rule_id=0)
 
+        # A known switch coming back may only need the changes it missed:
+        # first check that it still has the flows it had
+        if dpid in self.cambios_pendientes and Config.replay_on_reconnect:
+            self.logger.info(f"Switch {dpid} reconnected. Checking its flow table...")
+            req = self.solicitar_estadisticas(datapath)
+            self.verificaciones[(datapath, req.xid)] = set()
+            return
+        self.cambios_pendientes.pop(dpid, None)
+        self._instalar_todo(datapath)
+
+    def _instalar_todo(self, datapath):
+        """
+        Install every database rule and template that targets the switch.
+        """
+        dpid = datapath.id
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        if Config.use_group_tables:
+            # Start from an empty group table; groups are recreated as rules are installed
+            datapath.send_msg(parser.OFPGroupMod(datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_INDIRECT, ofproto.OFPG_ALL))
+            self.grupos[dpid] = {}
+
         self.logger.info(f"Switch {dpid} connected. Installing rules from the database...")
         reglas_db = self.obtener_reglas_desde_db().get(dpid, {})
         self.db_rules.setdefault(dpid, {}).update(reglas_db)
@@ -124,21 +227,162 @@ class DynamicFlowSwitch(app_manager.RyuApp):
             self.logger.info(f"Rules for {dpid} loaded ({len(reglas_db)} rules).")
         self._install_db_rules(datapath, reglas_db)
 
-    def add_flow(self, datapath, priority, match, actions, rule_id=0):
+        # Templates that target this switch (the switch starts with none of their flows)
+        for instaladas in self.plantillas_instaladas.values():
+            instaladas.pop(dpid, None)
+        for plantilla in self.db_plantillas.values():
+            if dpid in plantilla["dpids"]:
+                self._aplicar_plantilla_en_switch(datapath, plantilla["template_id"], plantilla)
+
+    @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
+    def state_change_handler(self, ev):
+        """
+        Forget disconnected switches and start queueing their changes.
+        """
+        datapath = ev.datapath
+        if ev.state != DEAD_DISPATCHER or datapath.id is None:
+            return
+        dpid = datapath.id
+        # Barriers and flow table checks sent on this connection will never be answered
+        perdidas = [clave for clave in self.trazas_pendientes if clave[0] is datapath]
+        for clave in perdidas:
+            del self.trazas_pendientes[clave]
+        for clave in [clave for clave in self.verificaciones if clave[0] is datapath]:
+            del self.verificaciones[clave]
+        if perdidas:
+            self.logger.warning(f"Switch {dpid} disconnected with {len(perdidas)} unconfirmed changes.")
+        # Ignore a stale connection if the switch has already reconnected
+        if self.datapaths.get(dpid) is not datapath:
+            return
+        del self.datapaths[dpid]
+        if dpid in self.installed_flows:
+            self.cambios_pendientes.setdefault(dpid, set())
+        self.logger.warning(f"Switch {dpid} disconnected. Changes will be queued until it reconnects.")
+
+    def encolar_cambio_pendiente(self, dpid, rule_id):
+        """
+        Remember that a rule of an offline switch (or one whose flow table is
+        being checked after reconnecting) changed. Repeated changes to the same
+        rule collapse into one entry; its final state is read on replay.
+        Returns False if the switch is not being tracked.
+        """
+        if dpid not in self.cambios_pendientes:
+            return False
+        self.cambios_pendientes[dpid].add(rule_id)
+        self.logger.info(f"Switch {dpid} not ready: change to rule {rule_id} queued.")
+        return True
+
+    def verificar_tabla_reconexion(self, datapath, cookies):
+        """
+        Compare the flows a reconnected switch reports with the ones it should
+        have kept. Replay only the pending changes if they match; otherwise the
+        switch lost its table (e.g. it rebooted) and everything is reinstalled.
+        """
+        dpid = datapath.id
+        if dpid not in self.cambios_pendientes:
+            return
+        reglas = self.db_rules.get(dpid, {})
+        esperadas = set(self.installed_flows.get(dpid, {}))
+        en_switch = {cookie for cookie in cookies if cookie and not cookie & COOKIE_PLANTILLA}
+        plantillas_esperadas = {self.cookie_plantilla(template_id, dpid)
+                                for template_id, instaladas in self.plantillas_instaladas.items() if dpid in instaladas}
+        plantillas_en_switch = {cookie for cookie in cookies if cookie & COOKIE_PLANTILLA}
+
+        # Rules with a TTL may have expired while the FlowRemoved could not be delivered
+        expiradas = {rule_id for rule_id in esperadas - en_switch
+                     if rule_id in reglas and (reglas[rule_id]["idle_timeout"] or reglas[rule_id]["hard_timeout"])}
+        # Rules already deleted from the database will be deleted by the replay anyway
+        faltan = {rule_id for rule_id in esperadas - en_switch - expiradas if rule_id in reglas}
+
+        if faltan or en_switch - esperadas or plantillas_en_switch != plantillas_esperadas:
+            self.logger.warning(f"Switch {dpid} does not have the expected flows ({len(faltan)} missing). "
+                                f"Reinstalling every rule...")
+            self.cambios_pendientes.pop(dpid, None)
+            # Remove flows of rules that no longer exist; the rest are overwritten
+            for cookie in en_switch - set(reglas):
+                self._eliminar_flujo_por_cookie(datapath, cookie)
+            self.installed_flows[dpid] = {}
+            self.reglas_expiradas.pop(dpid, None)
+            self._instalar_todo(datapath)
+            return
+
+        for rule_id in expiradas:
+            self._registrar_expiracion(datapath, rule_id, "while disconnected")
+            self.cambios_pendientes[dpid].discard(rule_id)
+        self.logger.info(f"Switch {dpid} kept its flow table. Replaying pending changes...")
+        hub.spawn(self.reproducir_cambios_pendientes, datapath)
+
+    def reproducir_cambios_pendientes(self, datapath):
+        """
+        Send a reconnected switch the net difference between the flows it
+        had and the current rules, in batches.
+        """
+        dpid = datapath.id
+        pendientes = self.cambios_pendientes.pop(dpid, set())
+        reglas = self.db_rules.get(dpid, {})
+        instaladas = self.installed_flows.get(dpid, {})
+
+        cambios = []
+        for rule_id in pendientes:
+            final = reglas.get(rule_id)
+            instalada = instaladas.get(rule_id)
+            if final is None and instalada is None:
+                continue
+            if final is None:
+                priority, match_dict, actions = instalada
+                cambios.append({"dpid": dpid, "rule_id": rule_id, "campo": "Eliminada",
+                                "valor_antiguo": {"priority": priority, "match_data": match_dict, "actions": actions}})
+            elif instalada is None:
+                cambios.append({"dpid": dpid, "rule_id": rule_id, "campo": "Creada", "valor_nuevo": final})
+            elif (instalada[0], instalada[1]) != (final["priority"], final["match_data"]):
+                cambios.append({"dpid": dpid, "rule_id": rule_id, "campo": "match_data"})
+            elif instalada[2] != final["actions"]:
+                cambios.append({"dpid": dpid, "rule_id": rule_id, "campo": "actions"})
+            else:
+                # Only the timeouts can differ; re-adding the flow is cheap
+                cambios.append({"dpid": dpid, "rule_id": rule_id, "campo": "timeouts"})
+
+        self.logger.info(f"Replaying {len(cambios)} of {len(pendientes)} queued changes on switch {dpid}.")
+        for inicio in range(0, len(cambios), Config.replay_batch_size):
+            if self.datapaths.get(dpid) is not datapath:
+                # Disconnected again: queue what is left
+                self.cambios_pendientes.setdefault(dpid, set()).update(c["rule_id"] for c in cambios[inicio:])
+                return
+            ahora = time.time()
+            self.aplicar_cambios_en_lote(cambios[inicio:inicio + Config.replay_batch_size],
+                                         {dpid: reglas}, {}, ahora, ahora)
+            hub.sleep(Config.replay_batch_pause)
+
+        # Templates: bring each one to its current state on this switch
+        for template_id, instaladas_plantilla in list(self.plantillas_instaladas.items()):
+            if dpid in instaladas_plantilla and template_id not in self.db_plantillas:
+                self._aplicar_plantilla_en_switch(datapath, template_id, None)
+        for plantilla in self.db_plantillas.values():
+            destino = plantilla if dpid in plantilla["dpids"] else None
+            self._aplicar_plantilla_en_switch(datapath, plantilla["template_id"], destino)
+
+    def add_flow(self, datapath, priority, match, actions, rule_id=0, idle_timeout=0, hard_timeout=0, command=None):
         """
-        Add a flow to the switch.
+        Add a flow to the switch (or modify it, if 'command' is OFPFC_MODIFY_STRICT).
         """
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
+        # Ask the switch to notify the expiry of flows with a TTL
+        flags = ofproto.OFPFF_SEND_FLOW_REM if (idle_timeout or hard_timeout) else 0
         mod = parser.OFPFlowMod(
             datapath=datapath,
             cookie=rule_id,  # Use the cookie field to identify the rule
+            command=ofproto.OFPFC_ADD if command is None else command,
             priority=priority,
             match=match,
+            idle_timeout=idle_timeout,
+            hard_timeout=hard_timeout,
+            flags=flags,
             instructions=inst
         )
         datapath.send_msg(mod)
+        return mod
 
     def _install_db_rules(self, datapath, reglas_nuevas):
         """
@@ -161,8 +405,9 @@ class DynamicFlowSwitch(app_manager.RyuApp):
                 self.logger.warning(f"Rule {rule_id} has no valid match in {dpid}.")
                 continue
             flow_match = parser.OFPMatch(**match_dict)
-            actions_openflow = self._parse_actions(rule["actions"], parser, ofproto)
-            self.add_flow(datapath, priority, flow_match, actions_openflow, rule_id=int(rule_id))
+            actions_openflow = self._acciones_para_flujo(datapath, rule_id, rule["actions"])
+            self.add_flow(datapath, priority, flow_match, actions_openflow, rule_id=int(rule_id),
+                          idle_timeout=rule.get("idle_timeout", 0), hard_timeout=rule.get("hard_timeout", 0))
             self.installed_flows.setdefault(dpid, {})[rule_id] = (priority, match_dict, rule["actions"])
             self.logger.info(f"Rule {rule_id} installed on switch {dpid}.")
             # Log the action
@@ -173,10 +418,27 @@ class DynamicFlowSwitch(app_manager.RyuApp):
         Monitor the database for rule changes and apply them dynamically.
         """
         while self.running:
+            perfil = cProfile.Profile() if Config.profile_slow_cycle_seconds is not None else None
+            inicio_ciclo = time.time()
+            if perfil:
+                perfil.enable()
             try:
                 nuevas_db = self.obtener_reglas_desde_db()
+                t_deteccion = time.time()
                 cambios_detectados = self.comparar_reglas(self.db_rules, nuevas_db)
-                if cambios_detectados:
+                if cambios_detectados and Config.use_group_tables:
+                    cambios_detectados = self.reasignar_grupos(cambios_detectados, nuevas_db)
+                t_diff = time.time()
+                eliminaciones = {}
+                if any(c["campo"] == "Eliminada" for c in cambios_detectados):
+                    eliminaciones = self.obtener_trazas_eliminacion()
+                en_lote = len(cambios_detectados) >= Config.bulk_change_threshold
+                # Small rollbacks also take the batch path
+                if cambios_detectados and not en_lote:
+                    en_lote = self.consumir_restauraciones(cambios_detectados, nuevas_db, eliminaciones)
+                if en_lote:
+                    self.aplicar_cambios_en_lote(cambios_detectados, nuevas_db, eliminaciones, t_deteccion, t_diff)
+                elif cambios_detectados:
                     for cambio in cambios_detectados:
                         dpid = cambio["dpid"]
                         rule_id = cambio["rule_id"]
@@ -184,13 +446,30 @@ class DynamicFlowSwitch(app_manager.RyuApp):
                         valor_antiguo = cambio.get("valor_antiguo")
                         valor_nuevo = cambio.get("valor_nuevo")
                         self.logger.info(f"Change detected on switch {dpid} for rule {rule_id}: {campo_modificado}.")
-                        self.aplicar_cambios(dpid, rule_id, campo_modificado, valor_antiguo, valor_nuevo)
-                    # Update the local copy of the database
-                    self.db_rules = nuevas_db
+                        if campo_modificado == "Eliminada":
+                            correlation_id, escritura = eliminaciones.get(rule_id, (None, None))
+                        else:
+                            regla = nuevas_db[dpid][rule_id]
+                            correlation_id, escritura = regla.get("correlation_id"), regla.get("updated_at")
+                        traza = self._nueva_traza(correlation_id, escritura, t_deteccion, t_diff)
+                        self.aplicar_cambios(dpid, rule_id, campo_modificado, valor_antiguo, valor_nuevo, traza=traza)
+                # Update the local copy of the database, also when reasignar_grupos
+                # already applied every change with a single group update
+                self.db_rules = nuevas_db
+
+                nuevas_plantillas = self.obtener_plantillas_desde_db()
+                if nuevas_plantillas is not None:
+                    for cambio in self.comparar_plantillas(self.db_plantillas, nuevas_plantillas):
+                        self.logger.info(f"Change detected for template {cambio['template_id']}: {cambio['campo']}.")
+                        self.aplicar_plantilla(cambio)
+                    self.db_plantillas = nuevas_plantillas
             except sqlite3.OperationalError as e:
                 self.logger.warning(f"SQLite error: {e}.")
             except Exception as e:
                 self.logger.error(f"Monitoring error: {e}.")
+            if perfil:
+                perfil.disable()
+                self._volcar_perfil(perfil, time.time() - inicio_ciclo)
             time.sleep(self.monitor_interval)
 
     def obtener_reglas_desde_db(self):
@@ -203,7 +482,8 @@ class DynamicFlowSwitch(app_manager.RyuApp):
             cursor = conn.cursor()
             cursor.execute("BEGIN EXCLUSIVE TRANSACTION;")
             cursor.execute(
-                "SELECT rule_id, dpid, priority, eth_type, ip_proto, ipv4_src, ipv4_dst, tcp_src, tcp_dst, in_port, actions FROM reglas"
+                "SELECT rule_id, dpid, priority, eth_type, ip_proto, ipv4_src, ipv4_dst, tcp_src, tcp_dst, in_port, actions, "
+                "idle_timeout, hard_timeout, correlation_id, updated_at FROM reglas"
             )
             reglas = cursor.fetchall()
             conn.commit()
@@ -212,48 +492,15 @@ class DynamicFlowSwitch(app_manager.RyuApp):
             reglas_dict = {}
             for regla in reglas:
                 (rule_id, dpid, priority, eth_type, ip_proto,
-                 ipv4_src, ipv4_dst, tcp_src, tcp_dst, in_port, actions) = regla
-
-                # Construct the match dict
-                match_dict = {
-                    "eth_type": eth_type,
-                    "ip_proto": ip_proto,
-                    "ipv4_src": ipv4_src,
-                    "ipv4_dst": ipv4_dst,
-                    "tcp_src": tcp_src,
-                    "tcp_dst": tcp_dst,
-                    "in_port": in_port
-                }
-                # Remove keys that are None
-                match_dict = {k: v for k, v in match_dict.items() if v is not None}
-
-                # Parse 'actions' if it's JSON
-                if isinstance(actions, str):
-                    try:
-                        actions_list = json.loads(actions)
-                    except json.JSONDecodeError:
-                        actions_list = []
-                elif isinstance(actions, list):
-                    actions_list = actions
-                else:
-                    actions_list = []
+                 ipv4_src, ipv4_dst, tcp_src, tcp_dst, in_port, actions,
+                 idle_timeout, hard_timeout, correlation_id, updated_at) = regla
 
                 # Save the rule both in match_data and top-level keys
-                reglas_dict.setdefault(dpid, {})[rule_id] = {
-                    "rule_id": rule_id,
-                    "dpid": dpid,
-                    "priority": priority,
-                    # Also add these fields so they are not None in logs
-                    "eth_type": eth_type,
-                    "ip_proto": ip_proto,
-                    "ipv4_src": ipv4_src,
-                    "ipv4_dst": ipv4_dst,
-                    "tcp_src": tcp_src,
-                    "tcp_dst": tcp_dst,
-                    "in_port": in_port,
-                    "match_data": match_dict,
-                    "actions": actions_list
-                }
+                reglas_dict.setdefault(dpid, {})[rule_id] = self._construir_regla(
+                    rule_id, dpid, priority, eth_type, ip_proto, ipv4_src, ipv4_dst,
+                    tcp_src, tcp_dst, in_port, actions, idle_timeout, hard_timeout,
+                    correlation_id, updated_at
+                )
             return reglas_dict
 
         except sqlite3.OperationalError as e:
@@ -263,6 +510,201 @@ class DynamicFlowSwitch(app_manager.RyuApp):
             self.logger.error(f"Error loading rules: {e}")
             return {}
 
+    def _construir_regla(self, rule_id, dpid, priority, eth_type, ip_proto, ipv4_src, ipv4_dst,
+                         tcp_src, tcp_dst, in_port, actions, idle_timeout=0, hard_timeout=0,
+                         correlation_id=None, updated_at=None):
+        """
+        Build the in-memory representation of a rule from its column values.
+        """
+        # Construct the match dict
+        match_dict = {
+            "eth_type": eth_type,
+            "ip_proto": ip_proto,
+            "ipv4_src": ipv4_src,
+            "ipv4_dst": ipv4_dst,
+            "tcp_src": tcp_src,
+            "tcp_dst": tcp_dst,
+            "in_port": in_port
+        }
+        # Remove keys that are None
+        match_dict = {k: v for k, v in match_dict.items() if v is not None}
+
+        # Parse 'actions' if it's JSON
+        if isinstance(actions, str):
+            try:
+                actions_list = json.loads(actions)
+            except json.JSONDecodeError:
+                actions_list = []
+        elif isinstance(actions, list):
+            actions_list = actions
+        else:
+            actions_list = []
+
+        return {
+            "rule_id": rule_id,
+            "dpid": dpid,
+            "priority": priority,
+            # Also add these fields so they are not None in logs
+            "eth_type": eth_type,
+            "ip_proto": ip_proto,
+            "ipv4_src": ipv4_src,
+            "ipv4_dst": ipv4_dst,
+            "tcp_src": tcp_src,
+            "tcp_dst": tcp_dst,
+            "in_port": in_port,
+            "match_data": match_dict,
+            "actions": actions_list,
+            "idle_timeout": idle_timeout or 0,
+            "hard_timeout": hard_timeout or 0,
+            # Last write to the rule, used to trace it down to the switch
+            "correlation_id": correlation_id,
+            "updated_at": updated_at
+        }
+
+    def obtener_plantillas_desde_db(self):
+        """
+        Load rule templates from the database, resolving each one to the
+        set of dpids it targets (explicit list and/or tag).
+        Returns None if the database could not be read.
+        """
+        try:
+            conn = self.obtener_conexion_bd()
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT template_id, dpids, etiqueta, priority, eth_type, ip_proto, ipv4_src, ipv4_dst, "
+                "tcp_src, tcp_dst, in_port, actions FROM plantillas"
+            )
+            plantillas = cursor.fetchall()
+            cursor.execute("SELECT dpid, etiqueta FROM switch_etiquetas")
+            etiquetas = {}
+            for dpid, etiqueta in cursor.fetchall():
+                etiquetas.setdefault(etiqueta, set()).add(dpid)
+            conn.close()
+        except sqlite3.Error as e:
+            self.logger.error(f"Error loading templates: {e}")
+            return None
+
+        plantillas_dict = {}
+        for plantilla in plantillas:
+            (template_id, dpids, etiqueta, priority, eth_type, ip_proto,
+             ipv4_src, ipv4_dst, tcp_src, tcp_dst, in_port, actions) = plantilla
+            destinos = set(json.loads(dpids)) if dpids else set()
+            if etiqueta:
+                destinos |= etiquetas.get(etiqueta, set())
+
+            datos = self._construir_regla(None, None, priority, eth_type, ip_proto, ipv4_src, ipv4_dst,
+                                          tcp_src, tcp_dst, in_port, actions)
+            datos["template_id"] = template_id
+            datos["dpids"] = destinos
+            plantillas_dict[template_id] = datos
+        return plantillas_dict
+
+    def comparar_plantillas(self, plantillas_antiguas, plantillas_nuevas):
+        """
+        Compare old and new templates. Each changed template produces a single
+        entry, whatever the number of switches it targets.
+        """
+        cambios = []
+        for template_id in set(plantillas_antiguas) | set(plantillas_nuevas):
+            antigua = plantillas_antiguas.get(template_id)
+            nueva = plantillas_nuevas.get(template_id)
+            if antigua is None:
+                campo = "Creada"
+            elif nueva is None:
+                campo = "Eliminada"
+            elif any(antigua.get(k) != nueva.get(k) for k in ("priority", "match_data", "actions", "dpids")):
+                campo = "Modificada"
+            else:
+                continue
+            cambios.append({
+                "template_id": template_id,
+                "campo": campo,
+                "valor_antiguo": antigua,
+                "valor_nuevo": nueva
+            })
+        return cambios
+
+    def cookie_plantilla(self, template_id, dpid):
+        """
+        Derive the cookie of a template's flow on a given switch.
+        """
+        return COOKIE_PLANTILLA | (template_id << 32) | (dpid & 0xFFFFFFFF)
+
+    def aplicar_plantilla(self, cambio):
+        """
+        Fan a template change out to every affected switch concurrently.
+        """
+        template_id = cambio["template_id"]
+        antigua = cambio["valor_antiguo"]
+        nueva = cambio["valor_nuevo"]
+        dpids_antiguos = antigua["dpids"] if antigua else set()
+        dpids_nuevos = nueva["dpids"] if nueva else set()
+
+        hilos = []
+        for dpid in dpids_antiguos | dpids_nuevos:
+            datapath = self.datapaths.get(dpid)
+            # Switches that are offline or being checked get their templates on replay
+            if not datapath or dpid in self.cambios_pendientes:
+                continue
+            plantilla = nueva if dpid in dpids_nuevos else None
+            hilos.append(hub.spawn(self._aplicar_plantilla_en_switch, datapath, template_id, plantilla))
+        hub.joinall(hilos)
+        self.logger.info(f"Template {template_id} applied on {len(hilos)} switches.")
+
+    def _aplicar_plantilla_en_switch(self, datapath, template_id, plantilla):
+        """
+        Bring the flow of a template on one switch to the given state
+        (None removes it).
+        """
+        dpid = datapath.id
+        cookie = self.cookie_plantilla(template_id, dpid)
+        instaladas = self.plantillas_instaladas.setdefault(template_id, {})
+        instalada = instaladas.get(dpid)
+
+        if plantilla is not None:
+            deseada = (plantilla["priority"], plantilla["match_data"], plantilla["actions"])
+            if instalada == deseada:
+                return
+        # A flow with a different match or priority would not be replaced by the new one
+        if instalada and (plantilla is None or instalada[:2] != deseada[:2]):
+            self._eliminar_flujo_por_cookie(datapath, cookie)
+
+        if plantilla is None:
+            if instalada:
+                del instaladas[dpid]
+                self._liberar_grupo(datapath, cookie, instalada[2])
+                self.guardar_log_en_sqlite({"dpid": dpid, "template_id": template_id}, action="ELIMINADA")
+            return
+
+        parser = datapath.ofproto_parser
+        match = parser.OFPMatch(**plantilla["match_data"])
+        actions_openflow = self._acciones_para_flujo(datapath, cookie, plantilla["actions"])
+        self.add_flow(datapath, plantilla["priority"], match, actions_openflow, rule_id=cookie)
+        instaladas[dpid] = deseada
+        if instalada and self._clave_acciones(instalada[2]) != self._clave_acciones(deseada[2]):
+            self._liberar_grupo(datapath, cookie, instalada[2])
+
+        # Log the action
+        regla = dict(plantilla, dpid=dpid)
+        self.guardar_log_en_sqlite(regla, action="MODIFICADA" if instalada else "INSTALADA")
+
+    def _eliminar_flujo_por_cookie(self, datapath, cookie):
+        """
+        Delete the flows carrying exactly this cookie from every table.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        mod_delete = parser.OFPFlowMod(
+            datapath=datapath,
+            cookie=cookie,
+            cookie_mask=0xFFFFFFFFFFFFFFFF,
+            table_id=ofproto.OFPTT_ALL,
+            command=ofproto.OFPFC_DELETE,
+            out_port=ofproto.OFPP_ANY,
+            out_group=ofproto.OFPG_ANY
+        )
+        datapath.send_msg(mod_delete)
+
     def comparar_reglas(self, reglas_antiguas, reglas_nuevas):
         """
         Compare old and new rules to detect changes.
@@ -324,23 +766,182 @@ class DynamicFlowSwitch(app_manager.RyuApp):
                         "valor_antiguo": old_rule.get("priority"),
                         "valor_nuevo": new_rule.get("priority")
                     })
+                nuevos_timeouts = (new_rule.get("idle_timeout", 0), new_rule.get("hard_timeout", 0))
+                antiguos_timeouts = (old_rule.get("idle_timeout", 0), old_rule.get("hard_timeout", 0))
+                if nuevos_timeouts != antiguos_timeouts:
+                    cambios.append({
+                        "dpid": dpid,
+                        "rule_id": rule_id,
+                        "campo": "timeouts",
+                        "valor_antiguo": antiguos_timeouts,
+                        "valor_nuevo": nuevos_timeouts
+                    })
         return cambios
 
-    def aplicar_cambios(self, dpid, rule_id, campo_modificado, valor_antiguo, valor_nuevo):
+    def aplicar_cambios(self, dpid, rule_id, campo_modificado, valor_antiguo, valor_nuevo, traza=None):
         """
         Apply changes to the switch based on detected rule modifications.
         """
-        if campo_modificado in ['priority', 'match_data', 'actions']:
-            self.actualizar_regla_switch(rule_id, campo_modificado, valor_nuevo, dpid)
+        if self.encolar_cambio_pendiente(dpid, rule_id):
+            return
+        self._marcar(traza, "aplicacion")
+        if campo_modificado in ['priority', 'match_data', 'actions', 'timeouts']:
+            self.actualizar_regla_switch(rule_id, campo_modificado, valor_nuevo, dpid, traza=traza)
         elif campo_modificado == "Eliminada":
+            # The switch already removed expired flows, nothing to delete
+            if rule_id in self.reglas_expiradas.get(dpid, set()):
+                self.reglas_expiradas[dpid].discard(rule_id)
+                return
             # For deletion, use the old information
-            self.eliminar_regla_switch(rule_id, dpid, valor_antiguo["match_data"], valor_antiguo["priority"])
+            self.eliminar_regla_switch(rule_id, dpid, valor_antiguo["match_data"], valor_antiguo["priority"], traza=traza)
             if rule_id in self.installed_flows.get(dpid, {}):
                 del self.installed_flows[dpid][rule_id]
+            # The flow is gone, so its group can be garbage-collected
+            datapath = self.datapaths.get(dpid)
+            if datapath:
+                self._liberar_grupo(datapath, rule_id, valor_antiguo["actions"])
         elif campo_modificado == "Creada":
-            self.instalar_nueva_regla(rule_id, valor_nuevo, dpid)
+            self.reglas_expiradas.get(dpid, set()).discard(rule_id)
+            self.instalar_nueva_regla(rule_id, valor_nuevo, dpid, traza=traza)
 
-    def actualizar_regla_switch(self, rule_id, campo, nuevo_valor, dpid):
+    def aplicar_cambios_en_lote(self, cambios, nuevas_db, eliminaciones, t_deteccion, t_diff):
+        """
+        Apply a large set of changes with the minimal FlowMods: one message per
+        affected rule (two if its match or priority changed), no waits between
+        them, and a single barrier per switch to confirm the batch.
+        """
+        # Collapse the per-field entries of each rule into one operation
+        por_regla = {}
+        for cambio in cambios:
+            por_regla.setdefault((cambio["dpid"], cambio["rule_id"]), []).append(cambio)
+
+        trazas = {}
+        logs = []
+        # Last FlowMod sent to each switch: the one its barrier confirms
+        ultimo_xid = {}
+        for (dpid, rule_id), lista in por_regla.items():
+            if self.encolar_cambio_pendiente(dpid, rule_id):
+                continue
+            datapath = self.datapaths.get(dpid)
+            if not datapath:
+                self.logger.warning(f"Switch {dpid} not found.")
+                continue
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            campos = {cambio["campo"] for cambio in lista}
+            instalada = self.installed_flows.get(dpid, {}).get(rule_id)
+
+            if "Eliminada" in campos:
+                correlation_id, escritura = eliminaciones.get(rule_id, (None, None))
+                # The switch already removed expired flows, nothing to delete
+                if rule_id in self.reglas_expiradas.get(dpid, set()):
+                    self.reglas_expiradas[dpid].discard(rule_id)
+                    continue
+                antigua = lista[0]["valor_antiguo"]
+                mod = self._eliminar_flujo_estricto(datapath, rule_id, antigua["match_data"], antigua["priority"])
+                self.installed_flows.get(dpid, {}).pop(rule_id, None)
+                self._liberar_grupo(datapath, rule_id, antigua["actions"])
+                logs.append(({"dpid": dpid, "rule_id": rule_id, "correlation_id": correlation_id}, "ELIMINADA", mod.xid))
+            else:
+                regla = nuevas_db[dpid][rule_id]
+                correlation_id, escritura = regla.get("correlation_id"), regla.get("updated_at")
+                if not regla["match_data"] or not regla["actions"] or regla["priority"] is None:
+                    continue
+                if "Creada" in campos:
+                    self.reglas_expiradas.get(dpid, set()).discard(rule_id)
+                # A different match or priority is a different flow: remove the old one
+                if instalada and (instalada[0], instalada[1]) != (regla["priority"], regla["match_data"]):
+                    self._eliminar_flujo_estricto(datapath, rule_id, instalada[1], instalada[0])
+                    instalada_misma = False
+                else:
+                    instalada_misma = instalada is not None
+                # Only the actions changed: modify in place and keep the flow counters
+                comando = ofproto.OFPFC_MODIFY_STRICT if instalada_misma and campos == {"actions"} else ofproto.OFPFC_ADD
+                actions_openflow = self._acciones_para_flujo(datapath, rule_id, regla["actions"])
+                mod = self.add_flow(datapath, regla["priority"], parser.OFPMatch(**regla["match_data"]), actions_openflow,
+                                    rule_id=int(rule_id), idle_timeout=regla["idle_timeout"],
+                                    hard_timeout=regla["hard_timeout"], command=comando)
+                if instalada and self._clave_acciones(instalada[2]) != self._clave_acciones(regla["actions"]):
+                    self._liberar_grupo(datapath, rule_id, instalada[2])
+                self.installed_flows.setdefault(dpid, {})[rule_id] = (regla["priority"], regla["match_data"], regla["actions"])
+                logs.append((regla, "INSTALADA" if "Creada" in campos else "MODIFICADA", mod.xid))
+
+            ultimo_xid[dpid] = mod.xid
+            if dpid not in trazas:
+                trazas[dpid] = (datapath, self._nueva_traza(correlation_id, escritura, t_deteccion, t_diff))
+                self._marcar(trazas[dpid][1], "aplicacion")
+
+        for dpid, (datapath, traza) in trazas.items():
+            self._marcar(traza, "flowmod", xid=ultimo_xid[dpid])
+        # Each log row keeps its own xid; the switch's trace is added when its barrier replies
+        log_ids = self.guardar_logs_en_lote(logs)
+        for dpid, (datapath, traza) in trazas.items():
+            self._solicitar_barrier(datapath, traza,
+                                    [log_id for log_id, entrada in zip(log_ids, logs) if entrada[0]["dpid"] == dpid])
+        self.logger.info(f"{len(por_regla)} rule changes applied in batch on {len(trazas)} switches.")
+
+    def _eliminar_flujo_estricto(self, datapath, rule_id, match_data, priority):
+        """
+        Delete exactly one rule's flow with a single message.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        match_dict = match_data if isinstance(match_data, dict) else json.loads(match_data)
+        mod_delete = parser.OFPFlowMod(
+            datapath=datapath,
+            cookie=int(rule_id),
+            cookie_mask=0xFFFFFFFFFFFFFFFF,
+            command=ofproto.OFPFC_DELETE_STRICT,
+            match=parser.OFPMatch(**match_dict),
+            priority=priority,
+            out_port=ofproto.OFPP_ANY,
+            out_group=ofproto.OFPG_ANY
+        )
+        datapath.send_msg(mod_delete)
+        return mod_delete
+
+    def guardar_logs_en_lote(self, entradas):
+        """
+        Save several (rule, action, FlowMod xid) log entries in a single transaction.
+        Returns the ids of the new rows in the same order (None if they could not be saved).
+        """
+        if not entradas:
+            return []
+        filas = [(
+            regla["dpid"],
+            regla.get("rule_id"),
+            action,
+            regla.get("priority", 1),
+            regla.get("eth_type"),
+            regla.get("ip_proto"),
+            regla.get("ipv4_src"),
+            regla.get("ipv4_dst"),
+            regla.get("tcp_src"),
+            regla.get("tcp_dst"),
+            regla.get("in_port"),
+            json.dumps(regla.get("actions", [])),
+            regla.get("template_id"),
+            regla.get("correlation_id"),
+            xid,
+            None
+        ) for regla, action, xid in entradas]
+        conn = self.obtener_conexion_bd()
+        try:
+            cursor = conn.cursor()
+            log_ids = []
+            for fila in filas:
+                cursor.execute(SQL_INSERTAR_LOG, fila)
+                log_ids.append(cursor.lastrowid)
+            conn.commit()
+            return log_ids
+        except sqlite3.Error as e:
+            conn.rollback()
+            self.logger.error(f"Error saving {len(filas)} logs to SQLite database: {e}")
+            return [None] * len(filas)
+        finally:
+            conn.close()
+
+    def actualizar_regla_switch(self, rule_id, campo, nuevo_valor, dpid, traza=None):
         """
         Update a rule on the switch.
         """
@@ -372,16 +973,23 @@ class DynamicFlowSwitch(app_manager.RyuApp):
         new_actions = regla_modificada["actions"]
         match_dict = new_match_data if isinstance(new_match_data, dict) else json.loads(new_match_data)
         match = parser.OFPMatch(**match_dict)
-        actions_openflow = self._parse_actions(new_actions, parser, ofproto)
-        self.add_flow(datapath, new_priority, match, actions_openflow, rule_id=int(rule_id))
+        actions_openflow = self._acciones_para_flujo(datapath, rule_id, new_actions)
+        mod = self.add_flow(datapath, new_priority, match, actions_openflow, rule_id=int(rule_id),
+                      idle_timeout=regla_modificada.get("idle_timeout", 0),
+                      hard_timeout=regla_modificada.get("hard_timeout", 0))
+        # Release the previous group only after the new flow points elsewhere
+        if installed_rule and self._clave_acciones(old_actions) != self._clave_acciones(new_actions):
+            self._liberar_grupo(datapath, rule_id, old_actions)
 
         self.installed_flows.setdefault(dpid, {})[rule_id] = (new_priority, match_dict, new_actions)
         self.logger.info(f"Rule {rule_id} updated on switch {dpid}.")
+        self._marcar(traza, "flowmod", xid=mod.xid)
 
         # Log the action
-        self.guardar_log_en_sqlite(regla_modificada, action="MODIFICADA")
+        log_id = self.guardar_log_en_sqlite(regla_modificada, action="MODIFICADA", traza=traza)
+        self._solicitar_barrier(datapath, traza, [log_id])
 
-    def eliminar_regla_switch(self, rule_id, dpid, match_data, priority):
+    def eliminar_regla_switch(self, rule_id, dpid, match_data, priority, traza=None):
         """
         Delete a rule from the switch.
         """
@@ -409,14 +1017,16 @@ class DynamicFlowSwitch(app_manager.RyuApp):
                 datapath.send_msg(mod_delete)
 
             self.logger.info(f"Rule {rule_id} deleted on switch {dpid}.")
+            self._marcar(traza, "flowmod", xid=mod_delete.xid)
             # Log the action
-            self.guardar_log_en_sqlite({"dpid": dpid, "rule_id": rule_id}, action="ELIMINADA")
+            log_id = self.guardar_log_en_sqlite({"dpid": dpid, "rule_id": rule_id}, action="ELIMINADA", traza=traza)
+            self._solicitar_barrier(datapath, traza, [log_id])
             return True
         except Exception as e:
             self.logger.error(f"Error deleting rule {rule_id} on switch {dpid}: {e}")
             return False
 
-    def instalar_nueva_regla(self, rule_id, nuevo_valor, dpid):
+    def instalar_nueva_regla(self, rule_id, nuevo_valor, dpid, traza=None):
         """
         Install a new rule on the switch.
         """
@@ -435,14 +1045,457 @@ class DynamicFlowSwitch(app_manager.RyuApp):
 
         match_dict = match_data if isinstance(match_data, dict) else json.loads(match_data)
         match = parser.OFPMatch(**match_dict)
-        actions_openflow = self._parse_actions(actions, parser, ofproto)
-        self.add_flow(datapath, priority, match, actions_openflow, rule_id=int(rule_id))
+        actions_openflow = self._acciones_para_flujo(datapath, rule_id, actions)
+        mod = self.add_flow(datapath, priority, match, actions_openflow, rule_id=int(rule_id),
+                      idle_timeout=nuevo_valor.get("idle_timeout", 0),
+                      hard_timeout=nuevo_valor.get("hard_timeout", 0))
 
         self.installed_flows.setdefault(dpid, {})[rule_id] = (priority, match_dict, actions)
         self.logger.info(f"New rule {rule_id} installed on switch {dpid}.")
+        self._marcar(traza, "flowmod", xid=mod.xid)
+
+        # Log the action
+        log_id = self.guardar_log_en_sqlite(nuevo_valor, action="INSTALADA", traza=traza)
+        self._solicitar_barrier(datapath, traza, [log_id])
+
+    def obtener_trazas_eliminacion(self):
+        """
+        Load and consume the correlation IDs of deleted rules:
+        rule_id -> (correlation_id, time of the delete request).
+        """
+        conn = self.obtener_conexion_bd()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT rule_id, correlation_id, updated_at FROM trazas_eliminacion")
+            trazas = {rule_id: (correlation_id, updated_at) for rule_id, correlation_id, updated_at in cursor.fetchall()}
+            if trazas:
+                cursor.executemany("DELETE FROM trazas_eliminacion WHERE rule_id = ?", [(r,) for r in trazas])
+                conn.commit()
+            return trazas
+        except sqlite3.Error as e:
+            self.logger.warning(f"Could not load deletion traces: {e}")
+            return {}
+        finally:
+            conn.close()
+
+    def consumir_restauraciones(self, cambios, nuevas_db, eliminaciones):
+        """
+        Tell whether any of the changes comes from a snapshot rollback, and
+        consume the rollback markers (and any older than an hour).
+        """
+        correlation_ids = set()
+        for cambio in cambios:
+            if cambio["campo"] == "Eliminada":
+                correlation_ids.add(eliminaciones.get(cambio["rule_id"], (None, None))[0])
+            else:
+                correlation_ids.add(nuevas_db.get(cambio["dpid"], {}).get(cambio["rule_id"], {}).get("correlation_id"))
+        correlation_ids.discard(None)
+        if not correlation_ids:
+            return False
+
+        conn = self.obtener_conexion_bd()
+        try:
+            cursor = conn.cursor()
+            marcadores = ", ".join("?" * len(correlation_ids))
+            cursor.execute(f"SELECT correlation_id FROM restauraciones WHERE correlation_id IN ({marcadores})",
+                           list(correlation_ids))
+            encontrados = [fila[0] for fila in cursor.fetchall()]
+            cursor.execute(f"DELETE FROM restauraciones WHERE correlation_id IN ({marcadores}) OR created_at < ?",
+                           list(correlation_ids) + [time.time() - 3600])
+            conn.commit()
+            return bool(encontrados)
+        except sqlite3.Error as e:
+            self.logger.warning(f"Could not load rollback markers: {e}")
+            return False
+        finally:
+            conn.close()
+
+    def _nueva_traza(self, correlation_id, escritura, deteccion, diff):
+        """
+        Start the trace of one change with the stages already completed.
+        """
+        etapas = {"escritura": escritura, "deteccion": deteccion, "diff": diff}
+        return {"correlation_id": correlation_id, "etapas": {k: v for k, v in etapas.items() if v is not None}}
+
+    def _marcar(self, traza, etapa, xid=None):
+        """
+        Record the time a traced change reached a stage.
+        """
+        if traza is None:
+            return
+        traza["etapas"][etapa] = time.time()
+        if xid is not None:
+            traza["xid"] = xid
+
+    def _resumir_traza(self, traza):
+        """
+        Turn the stage timestamps of a trace into the time spent in each stage (ms).
+        """
+        # Stage -> name of the time span that ends with it
+        tramos = [
+            ("deteccion", "espera_poll"),
+            ("diff", "diff"),
+            ("aplicacion", "cola"),
+            ("flowmod", "aplicacion"),
+            ("barrier", "switch"),
+        ]
+        etapas = traza["etapas"]
+        resumen = {}
+        anterior = etapas.get("escritura")
+        for etapa, tramo in tramos:
+            if etapa not in etapas:
+                continue
+            if anterior is not None:
+                resumen[tramo] = round((etapas[etapa] - anterior) * 1000, 3)
+            anterior = etapas[etapa]
+        inicio = etapas.get("escritura", etapas.get("deteccion"))
+        if inicio is not None and anterior is not None:
+            resumen["total"] = round((anterior - inicio) * 1000, 3)
+        return resumen
+
+    def _solicitar_barrier(self, datapath, traza, log_ids):
+        """
+        Send a barrier after a traced FlowMod; its reply marks the moment the switch processed it.
+        """
+        if traza is None:
+            return
+        barrier = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+        datapath.send_msg(barrier)
+        traza["log_ids"] = [log_id for log_id in log_ids if log_id is not None]
+        self.trazas_pendientes[(datapath, barrier.xid)] = traza
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def barrier_reply_handler(self, ev):
+        """
+        Complete the trace of a change and store its timing spans in the log row.
+        """
+        traza = self.trazas_pendientes.pop((ev.msg.datapath, ev.msg.xid), None)
+        if traza is None:
+            return
+        self._marcar(traza, "barrier")
+        resumen = self._resumir_traza(traza)
+        self.logger.info(f"Change {traza['correlation_id']} (xid {traza.get('xid')}) reached switch "
+                         f"{ev.msg.datapath.id}: {resumen}")
+        if not traza["log_ids"]:
+            return
+        conn = self.obtener_conexion_bd()
+        try:
+            conn.executemany("UPDATE logs SET traza = ? WHERE id = ?",
+                             [(json.dumps(resumen), log_id) for log_id in traza["log_ids"]])
+            conn.commit()
+        except sqlite3.Error as e:
+            self.logger.error(f"Error saving trace of change {traza['correlation_id']}: {e}")
+        finally:
+            conn.close()
+
+    def _volcar_perfil(self, perfil, duracion):
+        """
+        Dump the cProfile data of a reconciliation cycle slower than the configured threshold.
+        """
+        if duracion < Config.profile_slow_cycle_seconds:
+            return
+        try:
+            os.makedirs(Config.profile_dir, exist_ok=True)
+            ruta = os.path.join(Config.profile_dir, f"ciclo-{int(time.time())}.prof")
+            perfil.dump_stats(ruta)
+            self.logger.warning(f"Slow reconciliation cycle ({duracion:.2f} s), profile saved to {ruta}.")
+        except OSError as e:
+            self.logger.error(f"Could not save profile: {e}")
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def flow_removed_handler(self, ev):
+        """
+        Handle flows removed by the switch after an idle or hard timeout:
+        drop the rule from the database and record the expiry in the logs.
+        """
+        msg = ev.msg
+        dpid = msg.datapath.id
+        ofproto = msg.datapath.ofproto
+        if msg.reason not in (ofproto.OFPRR_IDLE_TIMEOUT, ofproto.OFPRR_HARD_TIMEOUT):
+            return
+        rule_id = self._rule_id_desde_cookie(dpid, msg.cookie)
+        if rule_id is None:
+            return
+
+        motivo = "idle" if msg.reason == ofproto.OFPRR_IDLE_TIMEOUT else "hard"
+        self._registrar_expiracion(msg.datapath, rule_id, f"{motivo} timeout")
+
+    def _registrar_expiracion(self, datapath, rule_id, motivo):
+        """
+        Forget a rule whose flow expired on the switch, delete it from the
+        database and log the expiry.
+        """
+        dpid = datapath.id
+        self.logger.info(f"Rule {rule_id} expired on switch {dpid} ({motivo}).")
+        regla = self.db_rules.get(dpid, {}).pop(rule_id, None) or {"dpid": dpid, "rule_id": rule_id}
+        instalada = self.installed_flows.get(dpid, {}).pop(rule_id, None)
+        self.reglas_expiradas.setdefault(dpid, set()).add(rule_id)
+        # The later deletion is skipped for expired rules, so release the group now
+        if instalada:
+            self._liberar_grupo(datapath, rule_id, instalada[2])
+
+        conn = self.obtener_conexion_bd()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM reglas WHERE rule_id = ? AND dpid = ?", (rule_id, dpid))
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            self.logger.error(f"Error deleting expired rule {rule_id}: {e}")
+        finally:
+            conn.close()
 
         # Log the action
-        self.guardar_log_en_sqlite(nuevo_valor, action="INSTALADA")
+        self.guardar_log_en_sqlite(regla, action="EXPIRADA")
+
+    def recolectar_estadisticas(self):
+        """
+        Periodically request flow statistics from every connected switch.
+        Requests are spread evenly over the interval so that the switches
+        do not all answer at the same moment.
+        """
+        while self.running:
+            dpids = list(self.datapaths.keys())
+            if not dpids:
+                hub.sleep(self.stats_interval)
+                continue
+            paso = float(self.stats_interval) / len(dpids)
+            for dpid in dpids:
+                datapath = self.datapaths.get(dpid)
+                if datapath:
+                    self.solicitar_estadisticas(datapath)
+                hub.sleep(paso)
+            try:
+                self.guardar_estadisticas_en_sqlite()
+                self.purgar_estadisticas()
+            except sqlite3.Error as e:
+                self.logger.error(f"Error saving flow statistics: {e}")
+
+    def solicitar_estadisticas(self, datapath):
+        """
+        Send a flow statistics request to the switch and return it.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        # The cookie mask is left empty so a single request covers every rule;
+        # the reply handler discards flows whose cookie is not a known rule.
+        req = parser.OFPFlowStatsRequest(
+            datapath,
+            0,
+            ofproto.OFPTT_ALL,
+            ofproto.OFPP_ANY,
+            ofproto.OFPG_ANY,
+            cookie=0,
+            cookie_mask=0
+        )
+        datapath.send_msg(req)
+        return req
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def flow_stats_reply_handler(self, ev):
+        """
+        Map the packet and byte counters of each flow back to its rule_id.
+        Replies to a reconnection check only collect the cookies of the flows.
+        """
+        clave = (ev.msg.datapath, ev.msg.xid)
+        if clave in self.verificaciones:
+            self.verificaciones[clave].update(stat.cookie for stat in ev.msg.body)
+            if not ev.msg.flags & ev.msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+                self.verificar_tabla_reconexion(ev.msg.datapath, self.verificaciones.pop(clave))
+            return
+        dpid = ev.msg.datapath.id
+        timestamp = int(time.time())
+        for stat in ev.msg.body:
+            rule_id = self._rule_id_desde_cookie(dpid, stat.cookie)
+            if rule_id is None:
+                continue
+            self.stats_buffer.append((timestamp, dpid, rule_id, stat.packet_count, stat.byte_count))
+        if len(self.stats_buffer) >= Config.stats_batch_size:
+            self.guardar_estadisticas_en_sqlite()
+
+    def _rule_id_desde_cookie(self, dpid, cookie):
+        """
+        Return the rule_id identified by a flow cookie, or None for flows
+        that do not belong to a database rule (e.g. the table-miss flow).
+        """
+        if cookie == 0:
+            return None
+        if cookie not in self.db_rules.get(dpid, {}):
+            return None
+        return cookie
+
+    def guardar_estadisticas_en_sqlite(self):
+        """
+        Write the buffered samples in a single batch, updating the
+        raw table and the 1-minute and 1-hour rollups.
+        """
+        if not self.stats_buffer:
+            return
+        muestras, self.stats_buffer = self.stats_buffer, []
+        conn = self.obtener_conexion_bd()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO estadisticas_raw (timestamp, dpid, rule_id, packet_count, byte_count)
+                VALUES (?, ?, ?, ?, ?)
+            """, muestras)
+            # Counters are cumulative, so each bucket keeps the latest sample it received
+            for tabla, resolucion in (("estadisticas_1m", 60), ("estadisticas_1h", 3600)):
+                cursor.executemany(f"""
+                    INSERT INTO {tabla} (bucket, dpid, rule_id, packet_count, byte_count)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(bucket, dpid, rule_id) DO UPDATE SET
+                        packet_count = excluded.packet_count,
+                        byte_count = excluded.byte_count
+                """, [(ts - ts % resolucion, dpid, rule_id, packets, bytes_)
+                      for ts, dpid, rule_id, packets, bytes_ in muestras])
+            conn.commit()
+            self.logger.info(f"{len(muestras)} flow statistics samples saved.")
+        except sqlite3.Error as e:
+            conn.rollback()
+            self.logger.error(f"Error saving flow statistics: {e}")
+        finally:
+            conn.close()
+
+    def purgar_estadisticas(self):
+        """
+        Delete statistics older than the retention of each resolution.
+        """
+        ahora = int(time.time())
+        conn = self.obtener_conexion_bd()
+        try:
+            cursor = conn.cursor()
+            for tabla, retencion in Config.stats_retention.items():
+                columna = "timestamp" if tabla == "estadisticas_raw" else "bucket"
+                cursor.execute(f"DELETE FROM {tabla} WHERE {columna} < ?", (ahora - retencion,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def retener_logs(self):
+        """
+        Periodically move old logs to the compressed archive. Rows are moved in
+        small batches, yielding between them so rule changes are not blocked.
+        """
+        while self.running:
+            hub.sleep(Config.logs_retention_interval)
+            try:
+                resumen = archivar_logs(
+                    self.db_path,
+                    Config.logs_archive_dir,
+                    max_dias=Config.logs_max_age_days,
+                    max_filas=Config.logs_max_rows,
+                    pausa=hub.sleep
+                )
+                if resumen["filas_archivadas"]:
+                    recuperados = resumen["bytes_recuperados"] + resumen["bytes_reutilizables"]
+                    self.logger.info(f"{resumen['filas_archivadas']} logs archived, {recuperados} bytes reclaimed.")
+            except (sqlite3.Error, OSError) as e:
+                self.logger.error(f"Log retention error: {e}")
+
+    def _clave_acciones(self, actions_data):
+        """
+        Return a canonical key identifying an action list.
+        """
+        if isinstance(actions_data, str):
+            try:
+                actions_data = json.loads(actions_data)
+            except json.JSONDecodeError:
+                actions_data = []
+        return json.dumps(actions_data, sort_keys=True)
+
+    def _acciones_para_flujo(self, datapath, rule_id, actions_data):
+        """
+        Return the OpenFlow actions for a rule's flow: the parsed actions
+        inline, or a single group action when group tables are enabled.
+        """
+        parser = datapath.ofproto_parser
+        ofproto = datapath.ofproto
+        actions = self._parse_actions(actions_data, parser, ofproto)
+        if not Config.use_group_tables or not actions:
+            return actions
+
+        dpid = datapath.id
+        grupos = self.grupos.setdefault(dpid, {})
+        clave = self._clave_acciones(actions_data)
+        grupo = grupos.get(clave)
+        if grupo is None:
+            group_id = max([g["group_id"] for g in grupos.values()] or [0]) + 1
+            grupo = {"group_id": group_id, "actions": json.loads(clave), "rules": set()}
+            grupos[clave] = grupo
+            datapath.send_msg(parser.OFPGroupMod(
+                datapath, ofproto.OFPGC_ADD, ofproto.OFPGT_INDIRECT, group_id,
+                [parser.OFPBucket(actions=actions)]
+            ))
+            self.logger.info(f"Group {group_id} created on switch {dpid}.")
+        grupo["rules"].add(rule_id)
+        return [parser.OFPActionGroup(grupo["group_id"])]
+
+    def _liberar_grupo(self, datapath, rule_id, actions_data):
+        """
+        Drop a rule's reference to its group and delete the group when no rule uses it.
+        """
+        if not Config.use_group_tables:
+            return
+        parser = datapath.ofproto_parser
+        ofproto = datapath.ofproto
+        dpid = datapath.id
+        grupos = self.grupos.get(dpid, {})
+        clave = self._clave_acciones(actions_data)
+        grupo = grupos.get(clave)
+        if grupo is None:
+            return
+        grupo["rules"].discard(rule_id)
+        if not grupo["rules"]:
+            datapath.send_msg(parser.OFPGroupMod(
+                datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_INDIRECT, grupo["group_id"]
+            ))
+            del grupos[clave]
+            self.logger.info(f"Group {grupo['group_id']} deleted on switch {dpid}.")
+
+    def reasignar_grupos(self, cambios, nuevas_db):
+        """
+        When every rule sharing a group changes from the same actions to the
+        same new actions, rewrite the group with a single OFPGroupMod instead
+        of reinstalling each flow. Returns the changes still to be applied.
+        """
+        # (dpid, old key, new key) -> rule_ids whose only action change is that one
+        candidatos = {}
+        for cambio in cambios:
+            if cambio["campo"] != "actions":
+                continue
+            clave = (cambio["dpid"], self._clave_acciones(cambio["valor_antiguo"]),
+                     self._clave_acciones(cambio["valor_nuevo"]))
+            candidatos.setdefault(clave, set()).add(cambio["rule_id"])
+
+        resueltos = set()
+        for (dpid, clave_antigua, clave_nueva), rule_ids in candidatos.items():
+            datapath = self.datapaths.get(dpid)
+            grupos = self.grupos.get(dpid, {})
+            grupo = grupos.get(clave_antigua)
+            if not datapath or grupo is None or grupo["rules"] != rule_ids or clave_nueva in grupos:
+                continue
+            parser = datapath.ofproto_parser
+            ofproto = datapath.ofproto
+            actions = self._parse_actions(clave_nueva, parser, ofproto)
+            if not actions:
+                continue
+            datapath.send_msg(parser.OFPGroupMod(
+                datapath, ofproto.OFPGC_MODIFY, ofproto.OFPGT_INDIRECT, grupo["group_id"],
+                [parser.OFPBucket(actions=actions)]
+            ))
+            grupo["actions"] = json.loads(clave_nueva)
+            grupos[clave_nueva] = grupos.pop(clave_antigua)
+            self.logger.info(f"Group {grupo['group_id']} modified on switch {dpid} for {len(rule_ids)} rules.")
+            for rule_id in rule_ids:
+                priority, match_dict, _ = self.installed_flows[dpid][rule_id]
+                self.installed_flows[dpid][rule_id] = (priority, match_dict, grupo["actions"])
+                # Log the action
+                self.guardar_log_en_sqlite(nuevas_db[dpid][rule_id], action="MODIFICADA")
+                resueltos.add((dpid, rule_id))
+
+        return [c for c in cambios
+                if not (c["campo"] == "actions" and (c["dpid"], c["rule_id"]) in resueltos)]
 
     def _parse_actions(self, actions_data, parser, ofproto):
         """
@@ -0,0 +1,52 @@
+import argparse
+import os
+import sqlite3
+
+from gunicorn.app.base import BaseApplication
+
+from server import app, DATABASE
+
+
+class ServidorProduccion(BaseApplication):
+    """
+    Run the Flask API under gunicorn with several worker processes,
+    each serving requests from a pool of threads.
+    """
+
+    def __init__(self, aplicacion, opciones):
+        self.aplicacion = aplicacion
+        self.opciones = opciones
+        super(ServidorProduccion, self).__init__()
+
+    def load_config(self):
+        for clave, valor in self.opciones.items():
+            self.cfg.set(clave, valor)
+
+    def load(self):
+        return self.aplicacion
+
+
+def activar_wal(db_path):
+    """
+    Switch the database to WAL mode, so readers do not block the writer.
+    The setting is stored in the database file.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Production server for the rules API.")
+    parser.add_argument("--bind", default="0.0.0.0:5000")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("SDN_WORKERS", 4)))
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("SDN_THREADS", 4)))
+    args = parser.parse_args()
+
+    activar_wal(DATABASE)
+    ServidorProduccion(app, {
+        "bind": args.bind,
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": "gthread",
+    }).run()
@@ -5,18 +5,31 @@ import sqlite3
 import json
 from flask_cors import CORS
 from contextlib import closing
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models"))
+from archivar_logs import buscar_en_archivo
+from versiones import crear_snapshot, diferencias, restaurar_version
+from validacion import validar_timeout
+from consultas import TABLAS_ESTADISTICAS, consultar_logs, reglas_inactivas, tasas_regla
 
 # Initialize Flask application with static and template folders
 app = Flask(__name__, static_folder=".", template_folder=".")
 CORS(app)
 
-# Define the path to the SQLite database
-DATABASE = "/home/ryu/Documents/ryu/proyectos/app_sqlite/reglas.db"
+# Define the path to the SQLite database (SDN_DB_PATH overrides it, e.g. for benchmarks)
+DATABASE = os.environ.get("SDN_DB_PATH", "/home/ryu/Documents/ryu/proyectos/app_sqlite/reglas.db")
+# Seconds a request waits for a database lock held by another worker
+DB_TIMEOUT = 30
+# Directory holding the compressed archive of old logs
+ARCHIVO_LOGS = "/home/ryu/Documents/ryu/proyectos/app_sqlite/archivo_logs"
 
 # Function to establish a connection to the SQLite database
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE)
+        g.db = sqlite3.connect(DATABASE, timeout=DB_TIMEOUT)
         g.db.row_factory = sqlite3.Row  # Enable access to rows as dictionaries
     return g.db
 
@@ -27,6 +40,19 @@ def close_db(error):
     if db is not None:
         db.close()
 
+def obtener_correlation_id():
+    """Return the correlation ID of the current write, taken from X-Correlation-ID or generated."""
+    if 'correlation_id' not in g:
+        g.correlation_id = request.headers.get("X-Correlation-ID") or uuid.uuid4().hex
+    return g.correlation_id
+
+# Return the correlation ID so the client can follow the change down to the switch
+@app.after_request
+def agregar_correlation_id(response):
+    if 'correlation_id' in g:
+        response.headers["X-Correlation-ID"] = g.correlation_id
+    return response
+
 @app.route('/')
 def index():
     # Render the main HTML page (index.html)
@@ -60,7 +86,9 @@ def obtener_reglas():
                 "tcp_src": regla["tcp_src"],
                 "tcp_dst": regla["tcp_dst"],
                 "in_port": regla["in_port"],
-                "actions": json.loads(regla["actions"]) if regla["actions"] else []
+                "actions": json.loads(regla["actions"]) if regla["actions"] else [],
+                "idle_timeout": regla["idle_timeout"],
+                "hard_timeout": regla["hard_timeout"]
             })
 
         return jsonify({"switches": reglas_lista})
@@ -93,7 +121,9 @@ def obtener_regla(rule_id):
             "tcp_src": regla["tcp_src"],
             "tcp_dst": regla["tcp_dst"],
             "in_port": regla["in_port"],
-            "actions": json.loads(regla["actions"]) if regla["actions"] else []
+            "actions": json.loads(regla["actions"]) if regla["actions"] else [],
+            "idle_timeout": regla["idle_timeout"],
+            "hard_timeout": regla["hard_timeout"]
         })
 
     except Exception as e:
@@ -117,10 +147,10 @@ def obtener_max_rule_id():
 
 @app.route("/reglas/<int:dpid>", methods=["POST"])
 def agregar_regla(dpid):
-    """Add a new rule to the SQLite database."""
+    """Add a new rule to the SQLite database. If no rule_id is given, the next free one is assigned."""
     try:
         data = request.json
-        if not all(k in data for k in ["rule_id", "eth_type", "priority", "actions"]):
+        if not all(k in data for k in ["eth_type", "priority", "actions"]):
             return jsonify({"error": "Missing required fields."}), 400
 
         try:
@@ -128,18 +158,34 @@ def agregar_regla(dpid):
         except ValueError:
             return jsonify({"error": "The 'actions' field must be valid JSON"}), 400
 
+        try:
+            idle_timeout = validar_timeout(data.get("idle_timeout"))
+            hard_timeout = validar_timeout(data.get("hard_timeout"))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+
         conn = get_db()
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM reglas WHERE rule_id = ?", (data["rule_id"],))
-        if cursor.fetchone():
-            return jsonify({"error": "A rule with this ID already exists."}), 400
+        # Take the write lock before reading MAX(rule_id) so that concurrent
+        # requests cannot be assigned the same ID
+        cursor.execute("BEGIN IMMEDIATE")
+        if data.get("rule_id") is not None:
+            rule_id = int(data["rule_id"])
+            cursor.execute("SELECT * FROM reglas WHERE rule_id = ?", (rule_id,))
+            if cursor.fetchone():
+                conn.rollback()
+                return jsonify({"error": "A rule with this ID already exists."}), 400
+        else:
+            cursor.execute("SELECT COALESCE(MAX(rule_id), 0) + 1 FROM reglas")
+            rule_id = cursor.fetchone()[0]
 
         cursor.execute("""
-            INSERT INTO reglas (dpid, rule_id, priority, eth_type, ip_proto, ipv4_src, ipv4_dst, tcp_src, tcp_dst, in_port, actions)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO reglas (dpid, rule_id, priority, eth_type, ip_proto, ipv4_src, ipv4_dst, tcp_src, tcp_dst, in_port, actions,
+                                idle_timeout, hard_timeout, correlation_id, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """, (
             dpid,
-            int(data["rule_id"]),
+            rule_id,
             int(data["priority"]),
             int(data["eth_type"]),
             int(data.get("ip_proto", 0)),
@@ -148,13 +194,22 @@ def agregar_regla(dpid):
             int(data.get("tcp_src", 0)) if data.get("tcp_src") else None,
             int(data.get("tcp_dst", 0)) if data.get("tcp_dst") else None,
             int(data.get("in_port", 0)) if data.get("in_port") else None,
-            json.dumps(data["actions"])
+            json.dumps(data["actions"]),
+            idle_timeout,
+            hard_timeout,
+            obtener_correlation_id(),
+            time.time()
         ))
 
         conn.commit()
-        return jsonify({"message": "Rule added successfully", "rule_id": data["rule_id"]})
+        return jsonify({"message": "Rule added successfully", "rule_id": rule_id,
+                        "correlation_id": obtener_correlation_id()})
 
+    except sqlite3.IntegrityError as e:
+        get_db().rollback()
+        return jsonify({"error": f"Invalid rule: {str(e)}"}), 400
     except Exception as e:
+        get_db().rollback()
         return jsonify({"error": f"Error adding rule: {str(e)}"}), 500
 
 @app.route("/reglas/modificar/<int:rule_id>", methods=["PUT"])
@@ -176,7 +231,7 @@ def modificar_regla(rule_id):
 
         valid_columns = [
             "dpid", "priority", "eth_type", "ip_proto", "ipv4_src", "ipv4_dst",
-            "tcp_src", "tcp_dst", "in_port", "actions"
+            "tcp_src", "tcp_dst", "in_port", "actions", "idle_timeout", "hard_timeout"
         ]
 
         fields_to_update = []
@@ -189,58 +244,320 @@ def modificar_regla(rule_id):
                         value = json.dumps(value)
                     except ValueError:
                         return jsonify({"error": "The 'actions' field must be valid JSON"}), 400
+                elif key in ("idle_timeout", "hard_timeout"):
+                    try:
+                        value = validar_timeout(value)
+                    except (TypeError, ValueError) as e:
+                        return jsonify({"error": str(e)}), 400
                 fields_to_update.append(f"{key} = ?")
                 values.append(value)
 
         if not fields_to_update:
             return jsonify({"error": "No valid fields provided for update"}), 400
 
+        fields_to_update += ["correlation_id = ?", "updated_at = ?"]
+        values += [obtener_correlation_id(), time.time()]
         values.append(rule_id)
         sql_update = f"UPDATE reglas SET {', '.join(fields_to_update)} WHERE rule_id = ?"
         cursor.execute(sql_update, values)
         conn.commit()
 
-        return jsonify({"message": "Rule modified successfully", "rule_id": rule_id})
+        return jsonify({"message": "Rule modified successfully", "rule_id": rule_id,
+                        "correlation_id": obtener_correlation_id()})
 
     except Exception as e:
         return jsonify({"error": f"Error modifying rule: {str(e)}"}), 500
 
 @app.route('/logs', methods=['GET'])
 def obtener_logs():
-    """Retrieve all change logs from the SQLite database."""
+    """Retrieve change logs from the SQLite database, optionally filtered and limited."""
+    try:
+        logs_lista = consultar_logs(
+            get_db().cursor(),
+            desde=request.args.get("desde"),
+            hasta=request.args.get("hasta"),
+            dpid=request.args.get("dpid", type=int),
+            limite=request.args.get("limite", type=int)
+        )
+        if not logs_lista:
+            return jsonify({"message": "No log records."}), 200
+
+        return jsonify(logs_lista)
+
+    except Exception as e:
+        return jsonify({"error": f"Error fetching logs: {str(e)}"}), 500
+
+@app.route('/snapshots', methods=['GET'])
+def obtener_snapshots():
+    """Retrieve the saved versions of the rule set."""
     try:
         conn = get_db()
         cursor = conn.cursor()
+        cursor.execute("SELECT version, nombre, created_at, num_reglas, completo FROM snapshots ORDER BY version")
+        return jsonify({"snapshots": [{
+            "version": fila["version"],
+            "nombre": fila["nombre"],
+            "created_at": fila["created_at"],
+            "num_reglas": fila["num_reglas"],
+            "completo": bool(fila["completo"])
+        } for fila in cursor.fetchall()]})
 
-        cursor.execute("SELECT * FROM logs ORDER BY timestamp DESC")
-        logs = cursor.fetchall()
+    except Exception as e:
+        return jsonify({"error": f"Error fetching snapshots: {str(e)}"}), 500
 
-        if not logs:
-            return jsonify({"message": "No log records."}), 200
+@app.route('/snapshots', methods=['POST'])
+def agregar_snapshot():
+    """Save the current rule set as a new named version."""
+    try:
+        data = request.json or {}
+        if not data.get("nombre"):
+            return jsonify({"error": "Missing required field 'nombre'."}), 400
+        version = crear_snapshot(get_db(), data["nombre"])
+        return jsonify({"message": "Snapshot created successfully", "version": version})
+
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "A snapshot with this name already exists."}), 400
+    except Exception as e:
+        return jsonify({"error": f"Error creating snapshot: {str(e)}"}), 500
 
-        logs_lista = []
-        for log in logs:
-            logs_lista.append({
-                "id": log["id"],
-                "timestamp": log["timestamp"],
-                "dpid": log["dpid"],
-                "rule_id": log["rule_id"],
-                "action": log["action"],
-                "priority": log["priority"],
-                "eth_type": log["eth_type"],
-                "ip_proto": log["ip_proto"],
-                "ipv4_src": log["ipv4_src"],
-                "ipv4_dst": log["ipv4_dst"],
-                "tcp_src": log["tcp_src"],
-                "tcp_dst": log["tcp_dst"],
-                "in_port": log["in_port"],
-                "actions": json.loads(log["actions"]) if log["actions"] else []
-            })
+@app.route('/snapshots/diff', methods=['GET'])
+def diferencias_snapshots():
+    """Compare two versions ('hasta' defaults to the current rules)."""
+    try:
+        desde = request.args.get("desde", type=int)
+        if desde is None:
+            return jsonify({"error": "Missing required parameter 'desde'."}), 400
+        return jsonify(diferencias(get_db().cursor(), desde, request.args.get("hasta", type=int)))
 
-        return jsonify(logs_lista)
+    except KeyError:
+        return jsonify({"error": "Snapshot not found"}), 404
+    except Exception as e:
+        return jsonify({"error": f"Error comparing snapshots: {str(e)}"}), 500
+
+@app.route('/snapshots/<int:version>/rollback', methods=['POST'])
+def rollback_snapshot(version):
+    """Atomically restore the rules of a version, touching only the rules that differ."""
+    try:
+        resumen = restaurar_version(get_db(), version, obtener_correlation_id())
+        resumen.update({"message": "Rollback completed", "version": version,
+                        "correlation_id": obtener_correlation_id()})
+        return jsonify(resumen)
 
+    except KeyError:
+        return jsonify({"error": "Snapshot not found"}), 404
     except Exception as e:
-        return jsonify({"error": f"Error fetching logs: {str(e)}"}), 500
+        return jsonify({"error": f"Error rolling back: {str(e)}"}), 500
+
+def plantilla_a_dict(plantilla):
+    """Convert a row of the 'plantillas' table to JSON-ready data."""
+    return {
+        "template_id": plantilla["template_id"],
+        "dpids": json.loads(plantilla["dpids"]) if plantilla["dpids"] else [],
+        "etiqueta": plantilla["etiqueta"],
+        "priority": plantilla["priority"],
+        "eth_type": plantilla["eth_type"],
+        "ip_proto": plantilla["ip_proto"],
+        "ipv4_src": plantilla["ipv4_src"],
+        "ipv4_dst": plantilla["ipv4_dst"],
+        "tcp_src": plantilla["tcp_src"],
+        "tcp_dst": plantilla["tcp_dst"],
+        "in_port": plantilla["in_port"],
+        "actions": json.loads(plantilla["actions"]) if plantilla["actions"] else []
+    }
+
+def validar_dpids(valor):
+    """Return a template's target dpids as a JSON list, or raise ValueError."""
+    if valor is None:
+        return None
+    if not isinstance(valor, list):
+        raise ValueError("The 'dpids' field must be a list of switch IDs")
+    return json.dumps(sorted({int(dpid) for dpid in valor}))
+
+@app.route('/plantillas', methods=['GET'])
+def obtener_plantillas():
+    """Retrieve all rule templates."""
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM plantillas")
+        return jsonify({"plantillas": [plantilla_a_dict(p) for p in cursor.fetchall()]})
+
+    except Exception as e:
+        return jsonify({"error": f"Error fetching templates: {str(e)}"}), 500
+
+@app.route('/plantillas', methods=['POST'])
+def agregar_plantilla():
+    """Add a rule template applied to a list of dpids and/or the switches with a tag."""
+    try:
+        data = request.json
+        if not all(k in data for k in ["template_id", "eth_type", "priority", "actions"]):
+            return jsonify({"error": "Missing required fields."}), 400
+        if not data.get("dpids") and not data.get("etiqueta"):
+            return jsonify({"error": "A template needs 'dpids' or 'etiqueta'."}), 400
+        try:
+            dpids = validar_dpids(data.get("dpids"))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM plantillas WHERE template_id = ?", (data["template_id"],))
+        if cursor.fetchone():
+            return jsonify({"error": "A template with this ID already exists."}), 400
+
+        cursor.execute("""
+            INSERT INTO plantillas (template_id, dpids, etiqueta, priority, eth_type, ip_proto, ipv4_src, ipv4_dst,
+                                    tcp_src, tcp_dst, in_port, actions)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            int(data["template_id"]),
+            dpids,
+            data.get("etiqueta"),
+            int(data["priority"]),
+            int(data["eth_type"]),
+            int(data.get("ip_proto", 0)),
+            data.get("ipv4_src"),
+            data.get("ipv4_dst"),
+            int(data.get("tcp_src", 0)) if data.get("tcp_src") else None,
+            int(data.get("tcp_dst", 0)) if data.get("tcp_dst") else None,
+            int(data.get("in_port", 0)) if data.get("in_port") else None,
+            json.dumps(data["actions"])
+        ))
+        conn.commit()
+        return jsonify({"message": "Template added successfully", "template_id": data["template_id"]})
+
+    except Exception as e:
+        return jsonify({"error": f"Error adding template: {str(e)}"}), 500
+
+@app.route('/plantillas/<int:template_id>', methods=['PUT'])
+def modificar_plantilla(template_id):
+    """Update an existing rule template."""
+    try:
+        data = request.json
+        if not data:
+            return jsonify({"error": "No data provided for modification"}), 400
+
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM plantillas WHERE template_id = ?", (template_id,))
+        if not cursor.fetchone():
+            return jsonify({"error": "Template not found"}), 404
+
+        valid_columns = [
+            "dpids", "etiqueta", "priority", "eth_type", "ip_proto", "ipv4_src", "ipv4_dst",
+            "tcp_src", "tcp_dst", "in_port", "actions"
+        ]
+        fields_to_update = []
+        values = []
+        for key, value in data.items():
+            if key not in valid_columns:
+                continue
+            if key == "actions":
+                value = json.dumps(value)
+            elif key == "dpids":
+                try:
+                    value = validar_dpids(value)
+                except (TypeError, ValueError) as e:
+                    return jsonify({"error": str(e)}), 400
+            fields_to_update.append(f"{key} = ?")
+            values.append(value)
+
+        if not fields_to_update:
+            return jsonify({"error": "No valid fields provided for update"}), 400
+
+        values.append(template_id)
+        cursor.execute(f"UPDATE plantillas SET {', '.join(fields_to_update)} WHERE template_id = ?", values)
+        conn.commit()
+        return jsonify({"message": "Template modified successfully", "template_id": template_id})
+
+    except sqlite3.IntegrityError:
+        return jsonify({"error": "A template needs 'dpids' or 'etiqueta'."}), 400
+    except Exception as e:
+        return jsonify({"error": f"Error modifying template: {str(e)}"}), 500
+
+@app.route('/plantillas/<int:template_id>', methods=['DELETE'])
+def eliminar_plantilla(template_id):
+    """Delete a rule template; its flows are removed from every switch."""
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM plantillas WHERE template_id = ?", (template_id,))
+        if cursor.rowcount == 0:
+            return jsonify({"error": "Template not found"}), 404
+        conn.commit()
+        return jsonify({"message": "Template deleted successfully", "template_id": template_id})
+
+    except sqlite3.Error as e:
+        return jsonify({"error": f"Error deleting template: {str(e)}"}), 500
+
+@app.route('/switches/<int:dpid>/etiquetas', methods=['GET', 'PUT'])
+def etiquetas_switch(dpid):
+    """Retrieve or replace the tags of a switch, used to target templates."""
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        if request.method == 'PUT':
+            etiquetas = request.json
+            if not isinstance(etiquetas, list) or not all(isinstance(e, str) and e for e in etiquetas):
+                return jsonify({"error": "Tags must be a list of non-empty strings"}), 400
+            cursor.execute("DELETE FROM switch_etiquetas WHERE dpid = ?", (dpid,))
+            cursor.executemany("INSERT OR IGNORE INTO switch_etiquetas (dpid, etiqueta) VALUES (?, ?)",
+                               [(dpid, etiqueta) for etiqueta in etiquetas])
+            conn.commit()
+
+        cursor.execute("SELECT etiqueta FROM switch_etiquetas WHERE dpid = ? ORDER BY etiqueta", (dpid,))
+        return jsonify({"dpid": dpid, "etiquetas": [fila["etiqueta"] for fila in cursor.fetchall()]})
+
+    except sqlite3.Error as e:
+        return jsonify({"error": f"Error updating tags: {str(e)}"}), 500
+
+@app.route('/estadisticas/<int:rule_id>', methods=['GET'])
+def obtener_estadisticas_regla(rule_id):
+    """Retrieve packet and byte rates of a rule from the flow statistics."""
+    try:
+        resolucion = request.args.get("resolucion", "1m")
+        if resolucion not in TABLAS_ESTADISTICAS:
+            return jsonify({"error": "Invalid resolution. Use raw, 1m or 1h."}), 400
+        desde = request.args.get("desde", type=int)
+
+        tasas = tasas_regla(get_db().cursor(), rule_id, resolucion, desde)
+        if tasas is None:
+            return jsonify({"message": "No statistics for this rule."}), 200
+
+        return jsonify({"rule_id": rule_id, "resolucion": resolucion, "tasas": tasas})
+
+    except Exception as e:
+        return jsonify({"error": f"Error fetching statistics: {str(e)}"}), 500
+
+@app.route('/estadisticas/inactivas', methods=['GET'])
+def obtener_reglas_inactivas():
+    """Retrieve the rules that matched no packets during the last 'ventana' seconds."""
+    try:
+        ventana = request.args.get("ventana", type=int, default=3600)
+        inactivas = reglas_inactivas(get_db().cursor(), ventana)
+        return jsonify({"ventana": ventana, "reglas": inactivas})
+
+    except Exception as e:
+        return jsonify({"error": f"Error fetching idle rules: {str(e)}"}), 500
+
+@app.route('/logs/archivo', methods=['GET'])
+def obtener_logs_archivados():
+    """Search the compressed log archive by time range and dpid."""
+    try:
+        logs = buscar_en_archivo(
+            ARCHIVO_LOGS,
+            desde=request.args.get("desde"),
+            hasta=request.args.get("hasta"),
+            dpid=request.args.get("dpid", type=int)
+        )
+        for log in logs:
+            log["actions"] = json.loads(log["actions"]) if log["actions"] else []
+            # Segments archived before the trace columns existed do not have them
+            log["traza"] = json.loads(log["traza"]) if log.get("traza") else None
+        return jsonify(logs)
+
+    except Exception as e:
+        return jsonify({"error": f"Error searching log archive: {str(e)}"}), 500
 
 @app.route("/reglas/eliminar/<int:rule_id>", methods=["DELETE"])
 def eliminar_regla(rule_id):
@@ -258,8 +575,12 @@ def eliminar_regla(rule_id):
 
         dpid = regla["dpid"]
 
-        # Delete the rule
+        # Delete the rule, keeping its correlation ID for the controller
         cursor.execute("DELETE FROM reglas WHERE rule_id = ?", (rule_id,))
+        cursor.execute(
+            "INSERT OR REPLACE INTO trazas_eliminacion (rule_id, correlation_id, updated_at) VALUES (?, ?, ?)",
+            (rule_id, obtener_correlation_id(), time.time())
+        )
         conn.commit()
 
         # Verify if the switch has more associated rules
@@ -274,7 +595,8 @@ def eliminar_regla(rule_id):
                 cursor.execute("DELETE FROM switches WHERE dpid = ?", (dpid,))
                 conn.commit()
 
-        return jsonify({"message": "Rule deleted successfully", "rule_id": rule_id})
+        return jsonify({"message": "Rule deleted successfully", "rule_id": rule_id,
+                        "correlation_id": obtener_correlation_id()})
 
     except sqlite3.Error as e:
         conn.rollback()
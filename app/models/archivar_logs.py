@@ -0,0 +1,162 @@
+import argparse
+import datetime
+import gzip
+import json
+import os
+import sqlite3
+import time
+
+DB_PATH = "/home/ryu/Documents/ryu/proyectos/app_sqlite/reglas.db"
+ARCHIVO_DIR = "/home/ryu/Documents/ryu/proyectos/app_sqlite/archivo_logs"
+
+
+def _ruta_segmento(directorio, timestamp, dpid):
+    """Devuelve el fichero de archivo de un día y un dpid concretos."""
+    fecha = (timestamp or "0000-00-00")[:10]
+    return os.path.join(directorio, f"logs-{fecha}-dpid{dpid}.jsonl.gz")
+
+
+def _escribir_lote(directorio, filas):
+    """
+    Añade las filas al archivo comprimido. Cada llamada agrega un miembro gzip
+    nuevo al final del fichero, así que el archivo solo crece y nunca se reescribe.
+    Devuelve los bytes escritos en disco.
+    """
+    os.makedirs(directorio, exist_ok=True)
+    segmentos = {}
+    for fila in filas:
+        ruta = _ruta_segmento(directorio, fila["timestamp"], fila["dpid"])
+        segmentos.setdefault(ruta, []).append(fila)
+
+    escritos = 0
+    for ruta, registros in segmentos.items():
+        tamano_previo = os.path.getsize(ruta) if os.path.exists(ruta) else 0
+        with open(ruta, "ab") as f:
+            with gzip.GzipFile(fileobj=f, mode="ab") as gz:
+                for registro in registros:
+                    gz.write((json.dumps(registro) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        escritos += os.path.getsize(ruta) - tamano_previo
+    return escritos
+
+
+def _espacio_libre(cursor):
+    """Bytes ocupados por páginas libres dentro del fichero SQLite."""
+    page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+    freelist = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_size * freelist
+
+
+def archivar_logs(db_path=DB_PATH, directorio=ARCHIVO_DIR, max_dias=30, max_filas=100000,
+                  lote=500, pausa=time.sleep, intervalo_pausa=0.05):
+    """
+    Mueve al archivo comprimido los logs más antiguos que `max_dias` y los que
+    superan las `max_filas` más recientes. Trabaja en transacciones pequeñas de
+    `lote` filas y llama a `pausa` entre lotes para no retener el bloqueo de escritura.
+    Devuelve un resumen con las filas archivadas y el espacio recuperado.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    tamano_inicial = os.path.getsize(db_path)
+    libre_inicial = _espacio_libre(cursor)
+
+    limite_fecha = (datetime.datetime.utcnow() - datetime.timedelta(days=max_dias)).strftime("%Y-%m-%d %H:%M:%S")
+    max_id = cursor.execute("SELECT MAX(id) FROM logs").fetchone()[0] or 0
+    limite_id = max_id - max_filas
+    # Se archivan todas las columnas de `logs`, incluidas las añadidas por migraciones
+    columnas = [fila["name"] for fila in cursor.execute("PRAGMA table_info(logs)").fetchall()]
+
+    archivadas = 0
+    bytes_archivo = 0
+    try:
+        while True:
+            filas = cursor.execute(f"""
+                SELECT {', '.join(columnas)} FROM logs
+                WHERE timestamp < ? OR id <= ?
+                ORDER BY id
+                LIMIT ?
+            """, (limite_fecha, limite_id, lote)).fetchall()
+            if not filas:
+                break
+
+            registros = [dict(fila) for fila in filas]
+            # Primero se escribe el archivo y después se borra: una interrupción
+            # puede duplicar un lote en el archivo, pero nunca perderlo.
+            bytes_archivo += _escribir_lote(directorio, registros)
+
+            ids = [registro["id"] for registro in registros]
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(f"DELETE FROM logs WHERE id IN ({', '.join('?' * len(ids))})", ids)
+            conn.commit()
+            # Devuelve al sistema las páginas liberadas si la base usa auto_vacuum incremental
+            # (executescript ejecuta el PRAGMA hasta el final; execute solo libera una página)
+            conn.executescript("PRAGMA incremental_vacuum;")
+
+            archivadas += len(ids)
+            pausa(intervalo_pausa)
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    finally:
+        libre_final = _espacio_libre(cursor)
+        conn.close()
+
+    tamano_final = os.path.getsize(db_path)
+    return {
+        "filas_archivadas": archivadas,
+        "bytes_archivo": bytes_archivo,
+        "bytes_recuperados": max(tamano_inicial - tamano_final, 0),
+        "bytes_reutilizables": max(libre_final - libre_inicial, 0),
+    }
+
+
+def buscar_en_archivo(directorio=ARCHIVO_DIR, desde=None, hasta=None, dpid=None):
+    """
+    Busca logs archivados entre `desde` y `hasta` (texto 'YYYY-MM-DD HH:MM:SS')
+    y, opcionalmente, de un único dpid. Solo se abren los ficheros cuyo día y
+    dpid pueden contener resultados.
+    """
+    if not os.path.isdir(directorio):
+        return []
+
+    resultados = []
+    for nombre in sorted(os.listdir(directorio)):
+        if not (nombre.startswith("logs-") and nombre.endswith(".jsonl.gz")):
+            continue
+        fecha, _, dpid_fichero = nombre[len("logs-"):-len(".jsonl.gz")].rpartition("-dpid")
+        if dpid is not None and dpid_fichero != str(dpid):
+            continue
+        if desde and fecha < desde[:10]:
+            continue
+        if hasta and fecha > hasta[:10]:
+            continue
+
+        with gzip.open(os.path.join(directorio, nombre), "rt", encoding="utf-8") as f:
+            for linea in f:
+                registro = json.loads(linea)
+                if desde and registro["timestamp"] < desde:
+                    continue
+                if hasta and registro["timestamp"] > hasta:
+                    continue
+                resultados.append(registro)
+
+    resultados.sort(key=lambda registro: registro["id"])
+    return resultados
+
+
+# 📌 Ejecutar la retención solo si el script se ejecuta directamente
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archiva y comprime los logs antiguos.")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--directorio", default=ARCHIVO_DIR)
+    parser.add_argument("--max-dias", type=int, default=30)
+    parser.add_argument("--max-filas", type=int, default=100000)
+    parser.add_argument("--lote", type=int, default=500)
+    args = parser.parse_args()
+
+    resumen = archivar_logs(args.db, args.directorio, args.max_dias, args.max_filas, args.lote)
+    print(f"✅ {resumen['filas_archivadas']} logs archivados "
+          f"({resumen['bytes_archivo']} bytes en el archivo, "
+          f"{resumen['bytes_recuperados'] + resumen['bytes_reutilizables']} bytes recuperados).")
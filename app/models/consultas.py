@@ -0,0 +1,117 @@
+import datetime
+import json
+
+# Tablas de estadísticas de flujos por resolución, con la columna que guarda el instante de la muestra
+TABLAS_ESTADISTICAS = {
+    "raw": ("estadisticas_raw", "timestamp"),
+    "1m": ("estadisticas_1m", "bucket"),
+    "1h": ("estadisticas_1h", "bucket"),
+}
+
+# Número de logs que devuelve `consultar_logs` si no se indica un límite
+LIMITE_LOGS = 500
+
+
+def _filas_a_dicts(cursor):
+    columnas = [descripcion[0] for descripcion in cursor.description]
+    return [dict(zip(columnas, fila)) for fila in cursor.fetchall()]
+
+
+def consultar_logs(cursor, desde=None, hasta=None, dpid=None, limite=None):
+    """
+    Devuelve los logs más recientes primero, filtrados por rango de fechas
+    ('YYYY-MM-DD HH:MM:SS') y dpid, con `actions` y `traza` ya decodificados.
+    Sin `limite` se devuelven como mucho LIMITE_LOGS registros.
+    """
+    condiciones = []
+    parametros = []
+    if desde:
+        condiciones.append("timestamp >= ?")
+        parametros.append(desde)
+    if hasta:
+        condiciones.append("timestamp <= ?")
+        parametros.append(hasta)
+    if dpid is not None:
+        condiciones.append("dpid = ?")
+        parametros.append(dpid)
+
+    sql = "SELECT * FROM logs"
+    if condiciones:
+        sql += " WHERE " + " AND ".join(condiciones)
+    sql += " ORDER BY timestamp DESC LIMIT ?"
+    parametros.append(limite or LIMITE_LOGS)
+
+    cursor.execute(sql, parametros)
+    logs = _filas_a_dicts(cursor)
+    for log in logs:
+        log["actions"] = json.loads(log["actions"]) if log["actions"] else []
+        log["traza"] = json.loads(log["traza"]) if log["traza"] else None
+    return logs
+
+
+def tasas_regla(cursor, rule_id, resolucion="1m", desde=None):
+    """
+    Devuelve las tasas de paquetes y bytes por segundo de una regla a partir
+    de sus muestras desde `desde` (por defecto, la última hora), o None si
+    no hay ninguna muestra.
+    """
+    tabla, columna = TABLAS_ESTADISTICAS[resolucion]
+    if desde is None:
+        desde = int(datetime.datetime.now().timestamp()) - 3600
+    cursor.execute(f"""
+        SELECT {columna} AS ts, dpid, packet_count, byte_count FROM {tabla}
+        WHERE rule_id = ? AND {columna} >= ?
+        ORDER BY dpid, {columna}
+    """, (rule_id, desde))
+    muestras = _filas_a_dicts(cursor)
+    if not muestras:
+        return None
+
+    # Las tasas se calculan entre muestras consecutivas del mismo switch.
+    # Un contador que baja significa que el flujo se reinstaló.
+    tasas = []
+    anterior = None
+    for muestra in muestras:
+        if anterior is not None and anterior["dpid"] == muestra["dpid"] and muestra["ts"] > anterior["ts"]:
+            segundos = muestra["ts"] - anterior["ts"]
+            paquetes = muestra["packet_count"] - anterior["packet_count"]
+            bytes_ = muestra["byte_count"] - anterior["byte_count"]
+            if paquetes < 0 or bytes_ < 0:
+                paquetes, bytes_ = muestra["packet_count"], muestra["byte_count"]
+            tasas.append({
+                "timestamp": muestra["ts"],
+                "dpid": muestra["dpid"],
+                "packet_count": muestra["packet_count"],
+                "byte_count": muestra["byte_count"],
+                "packets_per_second": paquetes / segundos,
+                "bytes_per_second": bytes_ / segundos
+            })
+        anterior = muestra
+    return tasas
+
+
+def reglas_inactivas(cursor, ventana=3600):
+    """Devuelve las reglas que no han recibido paquetes en los últimos `ventana` segundos."""
+    # El bucket justo anterior a la ventana sirve de referencia para los contadores
+    desde = int(datetime.datetime.now().timestamp()) - ventana - 60
+    cursor.execute("""
+        SELECT r.rule_id, r.dpid,
+               COUNT(e.bucket) AS muestras,
+               MIN(e.packet_count) AS min_packets,
+               MAX(e.packet_count) AS max_packets
+        FROM reglas r
+        LEFT JOIN estadisticas_1m e
+            ON e.rule_id = r.rule_id AND e.dpid = r.dpid AND e.bucket >= ?
+        GROUP BY r.rule_id, r.dpid
+    """, (desde,))
+
+    inactivas = []
+    for fila in _filas_a_dicts(cursor):
+        if fila["muestras"] == 0 or fila["min_packets"] == fila["max_packets"]:
+            inactivas.append({
+                "rule_id": fila["rule_id"],
+                "dpid": fila["dpid"],
+                "packet_count": fila["max_packets"],
+                "sin_muestras": fila["muestras"] == 0
+            })
+    return inactivas
@@ -1,10 +1,43 @@
 import sqlite3
 
-def inicializar_db():
+DB_PATH = "/home/ryu/Documents/ryu/proyectos/app_sqlite/reglas.db"
+
+# 📌 Definición de la tabla `logs` (también se usa para migrar bases de datos anteriores)
+SQL_TABLA_LOGS = """
+CREATE TABLE IF NOT EXISTS logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    dpid INTEGER,
+    rule_id INTEGER CHECK(rule_id > 0),
+    action TEXT CHECK(action IN ('INSTALADA', 'MODIFICADA', 'ELIMINADA', 'EXPIRADA')),
+    priority INTEGER CHECK(priority > 0),
+    eth_type INTEGER CHECK(eth_type > 0),
+    ip_proto INTEGER CHECK(ip_proto IS NULL OR ip_proto >= 0),
+    ipv4_src TEXT NULL,
+    ipv4_dst TEXT NULL,
+    tcp_src INTEGER CHECK(tcp_src IS NULL OR tcp_src > 0),
+    tcp_dst INTEGER CHECK(tcp_dst IS NULL OR tcp_dst > 0),
+    in_port INTEGER CHECK(in_port IS NULL OR in_port > 0),
+    actions TEXT CHECK(actions <> ''),
+    template_id INTEGER NULL,
+    correlation_id TEXT NULL,
+    xid INTEGER NULL,
+    traza TEXT NULL
+)
+"""
+
+def inicializar_db(db_path=DB_PATH):
     """Crea la base de datos y las tablas necesarias si no existen."""
-    conn = sqlite3.connect("/home/ryu/Documents/ryu/proyectos/app_sqlite/reglas.db")
+    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
+    # 📌 Permitir que la retención de logs devuelva al disco el espacio liberado
+    # (solo tiene efecto al crear la base de datos)
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    # 📌 Modo WAL: las lecturas no bloquean a las escrituras cuando la API usa varios workers
+    cursor.execute("PRAGMA journal_mode = WAL")
+
     # 📌 Crear tabla `reglas` si no existe con los tipos de datos correctos
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS reglas (
@@ -19,30 +52,152 @@ def inicializar_db():
             tcp_src INTEGER CHECK(tcp_src IS NULL OR tcp_src > 0),
             tcp_dst INTEGER CHECK(tcp_dst IS NULL OR tcp_dst > 0),
             in_port INTEGER CHECK(in_port IS NULL OR in_port > 0),
-            actions TEXT NOT NULL CHECK(actions <> '')
+            actions TEXT NOT NULL CHECK(actions <> ''),
+            idle_timeout INTEGER DEFAULT 0 CHECK(idle_timeout BETWEEN 0 AND 65535),
+            hard_timeout INTEGER DEFAULT 0 CHECK(hard_timeout BETWEEN 0 AND 65535),
+            correlation_id TEXT NULL,
+            updated_at REAL NULL
         )
     """)
 
+    # 📌 Añadir las columnas nuevas a bases de datos creadas con versiones anteriores
+    columnas = {fila[1] for fila in cursor.execute("PRAGMA table_info(reglas)")}
+    for columna, definicion in (("idle_timeout", "INTEGER DEFAULT 0"),
+                                ("hard_timeout", "INTEGER DEFAULT 0"),
+                                ("correlation_id", "TEXT NULL"),
+                                ("updated_at", "REAL NULL")):
+        if columna not in columnas:
+            cursor.execute(f"ALTER TABLE reglas ADD COLUMN {columna} {definicion}")
+
     # 📌 Crear tabla `logs` si no existe con los tipos de datos correctos
+    cursor.execute(SQL_TABLA_LOGS)
+
+    # 📌 Las bases de datos anteriores tienen un CHECK de `action` sin 'EXPIRADA'.
+    # SQLite no permite cambiar un CHECK, así que la tabla se reconstruye
+    sql_logs = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'logs'").fetchone()[0]
+    if "'EXPIRADA'" not in sql_logs:
+        columnas = ", ".join(fila[1] for fila in cursor.execute("PRAGMA table_info(logs)"))
+        conn.executescript(f"""
+            BEGIN;
+            ALTER TABLE logs RENAME TO logs_anterior;
+            {SQL_TABLA_LOGS};
+            INSERT INTO logs ({columnas}) SELECT {columnas} FROM logs_anterior;
+            DROP TABLE logs_anterior;
+            COMMIT;
+        """)
+        print("✅ Tabla `logs` migrada para admitir la acción EXPIRADA.")
+
+    # 📌 Añadir las columnas nuevas a bases de datos creadas con versiones anteriores
+    columnas = {fila[1] for fila in cursor.execute("PRAGMA table_info(logs)")}
+    for columna, definicion in (("template_id", "INTEGER NULL"),
+                                ("correlation_id", "TEXT NULL"),
+                                ("xid", "INTEGER NULL"),
+                                ("traza", "TEXT NULL")):
+        if columna not in columnas:
+            cursor.execute(f"ALTER TABLE logs ADD COLUMN {columna} {definicion}")
+
+    # 📌 `/logs` ordena por fecha y filtra por rango; el índice evita recorrer toda la tabla
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs (timestamp)")
+
+    # 📌 Crear tabla `trazas_eliminacion`: la fila de una regla borrada desaparece,
+    # así que su correlation_id se guarda aquí hasta que el controlador lo procesa
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS logs (
+        CREATE TABLE IF NOT EXISTS trazas_eliminacion (
+            rule_id INTEGER PRIMARY KEY,
+            correlation_id TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+    # 📌 Crear tabla `snapshots`: versiones con nombre del conjunto de reglas.
+    # Cada versión guarda un delta comprimido respecto a la anterior, salvo los
+    # checkpoints periódicos, que guardan el conjunto completo
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS snapshots (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT UNIQUE NOT NULL,
+            created_at REAL NOT NULL,
+            completo INTEGER NOT NULL CHECK(completo IN (0, 1)),
+            num_reglas INTEGER NOT NULL,
+            datos BLOB NOT NULL
+        )
+    """)
+
+    # 📌 Crear tabla `restauraciones`: marca los cambios de un rollback (por su
+    # correlation_id) para que el controlador los aplique siempre en lote
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS restauraciones (
+            correlation_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+
+    # 📌 Crear tabla `plantillas`: una regla que se expande en varios switches,
+    # indicados con una lista de dpids (JSON) o con una etiqueta
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS plantillas (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            dpid INTEGER,
-            rule_id INTEGER CHECK(rule_id > 0),
-            action TEXT CHECK(action IN ('INSTALADA', 'MODIFICADA', 'ELIMINADA')),
-            priority INTEGER CHECK(priority > 0),
-            eth_type INTEGER CHECK(eth_type > 0),
+            template_id INTEGER UNIQUE NOT NULL CHECK(template_id > 0 AND template_id < 2147483648),
+            dpids TEXT NULL,
+            etiqueta TEXT NULL,
+            priority INTEGER DEFAULT 1 CHECK(priority > 0),
+            eth_type INTEGER NOT NULL CHECK(eth_type > 0),
             ip_proto INTEGER CHECK(ip_proto IS NULL OR ip_proto >= 0),
             ipv4_src TEXT NULL,
             ipv4_dst TEXT NULL,
             tcp_src INTEGER CHECK(tcp_src IS NULL OR tcp_src > 0),
             tcp_dst INTEGER CHECK(tcp_dst IS NULL OR tcp_dst > 0),
             in_port INTEGER CHECK(in_port IS NULL OR in_port > 0),
-            actions TEXT CHECK(actions <> '')
+            actions TEXT NOT NULL CHECK(actions <> ''),
+            CHECK(dpids IS NOT NULL OR etiqueta IS NOT NULL)
+        )
+    """)
+
+    # 📌 Crear tabla `switch_etiquetas` para agrupar switches por etiqueta
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS switch_etiquetas (
+            dpid INTEGER NOT NULL,
+            etiqueta TEXT NOT NULL,
+            PRIMARY KEY (dpid, etiqueta)
         )
     """)
 
+    # 📌 Crear tablas de estadísticas de flujos (muestras crudas y agregados de 1 minuto y 1 hora)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS estadisticas_raw (
+            timestamp INTEGER NOT NULL,
+            dpid INTEGER NOT NULL,
+            rule_id INTEGER NOT NULL,
+            packet_count INTEGER NOT NULL,
+            byte_count INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_estadisticas_raw_regla
+        ON estadisticas_raw (rule_id, timestamp)
+    """)
+    # 📌 La purga periódica borra por antigüedad; sin este índice recorre toda la tabla
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_estadisticas_raw_timestamp
+        ON estadisticas_raw (timestamp)
+    """)
+    for tabla in ("estadisticas_1m", "estadisticas_1h"):
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {tabla} (
+                bucket INTEGER NOT NULL,
+                dpid INTEGER NOT NULL,
+                rule_id INTEGER NOT NULL,
+                packet_count INTEGER NOT NULL,
+                byte_count INTEGER NOT NULL,
+                PRIMARY KEY (bucket, dpid, rule_id)
+            )
+        """)
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_{tabla}_regla
+            ON {tabla} (rule_id, bucket)
+        """)
+
     conn.commit()
     conn.close()
     print("✅ Base de datos y tablas creadas correctamente.")
@@ -0,0 +1,31 @@
+def validar_timeout(valor):
+    """Devuelve un timeout de flujo como entero en segundos o lanza ValueError."""
+    valor = int(valor or 0)
+    if not 0 <= valor <= 65535:
+        raise ValueError("Timeouts must be between 0 and 65535 seconds")
+    return valor
+
+
+def validar_regla(regla):
+    """
+    Comprueba una regla (columna -> valor) contra las restricciones de la
+    tabla `reglas`, para poder rechazarla antes de aplicarla a los switches.
+    Lanza ValueError con el motivo si la base de datos no la aceptaría.
+    """
+    if regla.get("dpid") is None:
+        raise ValueError("The 'dpid' field is required")
+    if regla.get("rule_id") is None or regla["rule_id"] <= 0:
+        raise ValueError("The 'rule_id' field must be greater than 0")
+    if regla.get("priority") is None or regla["priority"] <= 0:
+        raise ValueError("The 'priority' field must be greater than 0")
+    if regla.get("eth_type") is None or regla["eth_type"] <= 0:
+        raise ValueError("The 'eth_type' field must be greater than 0")
+    if regla.get("ip_proto") is not None and regla["ip_proto"] < 0:
+        raise ValueError("The 'ip_proto' field cannot be negative")
+    for campo in ("tcp_src", "tcp_dst", "in_port"):
+        if regla.get(campo) is not None and regla[campo] <= 0:
+            raise ValueError(f"The '{campo}' field must be greater than 0")
+    if regla.get("actions") in (None, ""):
+        raise ValueError("The 'actions' field is required")
+    for campo in ("idle_timeout", "hard_timeout"):
+        validar_timeout(regla.get(campo))
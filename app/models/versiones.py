@@ -0,0 +1,174 @@
+import json
+import time
+import zlib
+
+# Columnas de `reglas` que forman parte de una versión
+COLUMNAS_VERSION = [
+    "rule_id", "dpid", "priority", "eth_type", "ip_proto", "ipv4_src", "ipv4_dst",
+    "tcp_src", "tcp_dst", "in_port", "actions", "idle_timeout", "hard_timeout"
+]
+
+# Cada cuántas versiones se guarda el conjunto completo en lugar de un delta,
+# para acotar el número de deltas que hay que aplicar al reconstruir una versión
+CHECKPOINT_CADA = 20
+
+
+def _comprimir(datos):
+    return zlib.compress(json.dumps(datos, sort_keys=True).encode("utf-8"))
+
+
+def _descomprimir(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+def reglas_actuales(cursor):
+    """Devuelve el contenido actual de `reglas` como {rule_id: fila}."""
+    cursor.execute(f"SELECT {', '.join(COLUMNAS_VERSION)} FROM reglas")
+    return {str(fila[0]): dict(zip(COLUMNAS_VERSION, fila)) for fila in cursor.fetchall()}
+
+
+def calcular_delta(origen, destino):
+    """
+    Diferencia mínima entre dos conjuntos de reglas: las reglas nuevas o
+    cambiadas en `destino` y los rule_id que ya no existen.
+    """
+    return {
+        "cambiadas": {rule_id: fila for rule_id, fila in destino.items() if origen.get(rule_id) != fila},
+        "eliminadas": sorted(rule_id for rule_id in origen if rule_id not in destino),
+    }
+
+
+def aplicar_delta(reglas, delta):
+    reglas = dict(reglas)
+    for rule_id in delta["eliminadas"]:
+        reglas.pop(rule_id, None)
+    reglas.update(delta["cambiadas"])
+    return reglas
+
+
+def reconstruir_version(cursor, version):
+    """
+    Reconstruye el conjunto de reglas de una versión partiendo del último
+    checkpoint completo y aplicando los deltas posteriores.
+    """
+    cursor.execute("SELECT MAX(version) FROM snapshots WHERE version <= ? AND completo = 1", (version,))
+    checkpoint = cursor.fetchone()[0]
+    if checkpoint is None:
+        raise KeyError(version)
+
+    cursor.execute(
+        "SELECT version, completo, datos FROM snapshots WHERE version BETWEEN ? AND ? ORDER BY version",
+        (checkpoint, version)
+    )
+    filas = cursor.fetchall()
+    if not filas or filas[-1][0] != version:
+        raise KeyError(version)
+
+    reglas = {}
+    for _, completo, datos in filas:
+        datos = _descomprimir(datos)
+        reglas = datos if completo else aplicar_delta(reglas, datos)
+    return reglas
+
+
+def crear_snapshot(conn, nombre):
+    """
+    Guarda el estado actual de `reglas` como una nueva versión con nombre.
+    Devuelve el número de versión.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        actuales = reglas_actuales(cursor)
+        cursor.execute("SELECT MAX(version) FROM snapshots")
+        ultima = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM snapshots")
+        completo = ultima is None or cursor.fetchone()[0] % CHECKPOINT_CADA == 0
+        datos = actuales if completo else calcular_delta(reconstruir_version(cursor, ultima), actuales)
+
+        cursor.execute(
+            "INSERT INTO snapshots (nombre, created_at, completo, num_reglas, datos) VALUES (?, ?, ?, ?, ?)",
+            (nombre, time.time(), int(completo), len(actuales), _comprimir(datos))
+        )
+        version = cursor.lastrowid
+        conn.commit()
+        return version
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _fila_publica(fila):
+    """Copia de una fila con `actions` decodificado, como la devuelve el resto de la API."""
+    return dict(fila, actions=json.loads(fila["actions"]) if fila["actions"] else [])
+
+
+def diferencias(cursor, desde, hasta=None):
+    """
+    Compara dos versiones (hasta=None compara con el estado actual).
+    Devuelve las reglas creadas, modificadas y eliminadas entre ambas.
+    """
+    origen = reconstruir_version(cursor, desde)
+    destino = reglas_actuales(cursor) if hasta is None else reconstruir_version(cursor, hasta)
+    delta = calcular_delta(origen, destino)
+    return {
+        "creadas": [_fila_publica(fila) for rule_id, fila in delta["cambiadas"].items() if rule_id not in origen],
+        "modificadas": [{"antes": _fila_publica(origen[rule_id]), "despues": _fila_publica(fila)}
+                        for rule_id, fila in delta["cambiadas"].items() if rule_id in origen],
+        "eliminadas": [_fila_publica(origen[rule_id]) for rule_id in delta["eliminadas"]],
+    }
+
+
+def restaurar_version(conn, version, correlation_id=None):
+    """
+    Devuelve `reglas` al estado de una versión en una única transacción,
+    tocando solo las filas que difieren. El controlador verá todo el cambio
+    en un mismo ciclo y, al estar marcado en `restauraciones`, enviará solo
+    los FlowMods necesarios aunque sean pocos.
+    Devuelve el número de reglas creadas, modificadas y eliminadas.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        objetivo = reconstruir_version(cursor, version)
+        actuales = reglas_actuales(cursor)
+        delta = calcular_delta(actuales, objetivo)
+        ahora = time.time()
+
+        cursor.executemany("DELETE FROM reglas WHERE rule_id = ?", [(int(r),) for r in delta["eliminadas"]])
+        cursor.executemany(
+            "INSERT OR REPLACE INTO trazas_eliminacion (rule_id, correlation_id, updated_at) VALUES (?, ?, ?)",
+            [(int(r), correlation_id, ahora) for r in delta["eliminadas"]] if correlation_id else []
+        )
+
+        modificadas = 0
+        for rule_id, fila in delta["cambiadas"].items():
+            valores = [fila[c] for c in COLUMNAS_VERSION] + [correlation_id, ahora]
+            if rule_id in actuales:
+                modificadas += 1
+                columnas = COLUMNAS_VERSION[1:] + ["correlation_id", "updated_at"]
+                cursor.execute(
+                    f"UPDATE reglas SET {', '.join(c + ' = ?' for c in columnas)} WHERE rule_id = ?",
+                    valores[1:] + [valores[0]]
+                )
+            else:
+                columnas = COLUMNAS_VERSION + ["correlation_id", "updated_at"]
+                cursor.execute(
+                    f"INSERT INTO reglas ({', '.join(columnas)}) VALUES ({', '.join('?' * len(columnas))})",
+                    valores
+                )
+        if correlation_id and (delta["cambiadas"] or delta["eliminadas"]):
+            cursor.execute(
+                "INSERT OR REPLACE INTO restauraciones (correlation_id, version, created_at) VALUES (?, ?, ?)",
+                (correlation_id, version, ahora)
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    return {
+        "creadas": len(delta["cambiadas"]) - modificadas,
+        "modificadas": modificadas,
+        "eliminadas": len(delta["eliminadas"]),
+    }
@@ -0,0 +1,133 @@
+"""
+Prueba de carga de la API de reglas en modo producción.
+
+Arranca app/controllers/serve.py con 1, 4 y 16 workers sobre una base de datos
+temporal, lanza tráfico mixto de lectura y escritura y muestra, para cada caso,
+las peticiones por segundo y las latencias p50 y p99.
+
+    python benchmarks/carga_api.py --duracion 20 --clientes 32
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(RAIZ, "app", "models"))
+from database import inicializar_db
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def esperar_servidor(url, proceso, limite=30):
+    inicio = time.time()
+    while time.time() - inicio < limite:
+        if proceso.poll() is not None:
+            raise RuntimeError("The server exited before accepting requests")
+        try:
+            requests.get(f"{url}/reglas/max_rule_id", timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError("The server did not start in time")
+
+
+def cliente(url, fin, proporcion_escritura, latencias, errores):
+    """Send requests until `fin`, recording the latency of each one."""
+    sesion = requests.Session()
+    while time.time() < fin:
+        operacion = random.random()
+        inicio = time.perf_counter()
+        try:
+            if operacion < proporcion_escritura / 2:
+                respuesta = sesion.post(f"{url}/reglas/{random.randint(1, 16)}", json={
+                    "priority": random.randint(1, 1000),
+                    "eth_type": 2048,
+                    "ipv4_dst": f"10.0.{random.randint(0, 255)}.{random.randint(1, 254)}",
+                    "actions": [{"type": "OUTPUT", "port": random.randint(1, 4)}]
+                })
+            elif operacion < proporcion_escritura:
+                respuesta = sesion.put(f"{url}/reglas/modificar/{random.randint(1, 200)}",
+                                       json={"priority": random.randint(1, 1000)})
+            elif operacion < 0.9:
+                respuesta = sesion.get(f"{url}/reglas/buscar/{random.randint(1, 200)}")
+            else:
+                respuesta = sesion.get(f"{url}/reglas")
+            if respuesta.status_code >= 500:
+                errores.append(respuesta.status_code)
+        except requests.RequestException as e:
+            errores.append(str(e))
+        latencias.append(time.perf_counter() - inicio)
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(int(len(ordenados) * p / 100), len(ordenados) - 1)]
+
+
+def ejecutar_caso(workers, threads, clientes, duracion, proporcion_escritura):
+    with tempfile.TemporaryDirectory() as directorio:
+        db_path = os.path.join(directorio, "reglas.db")
+        with contextlib.redirect_stdout(io.StringIO()):
+            inicializar_db(db_path)
+        puerto = puerto_libre()
+        url = f"http://127.0.0.1:{puerto}"
+        proceso = subprocess.Popen(
+            [sys.executable, "serve.py", "--bind", f"127.0.0.1:{puerto}",
+             "--workers", str(workers), "--threads", str(threads)],
+            cwd=os.path.join(RAIZ, "app", "controllers"),
+            env=dict(os.environ, SDN_DB_PATH=db_path),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        try:
+            esperar_servidor(url, proceso)
+            latencias = []
+            errores = []
+            fin = time.time() + duracion
+            hilos = [threading.Thread(target=cliente, args=(url, fin, proporcion_escritura, latencias, errores))
+                     for _ in range(clientes)]
+            for hilo in hilos:
+                hilo.start()
+            for hilo in hilos:
+                hilo.join()
+        finally:
+            proceso.terminate()
+            proceso.wait()
+
+    return {
+        "workers": workers,
+        "peticiones": len(latencias),
+        "rps": len(latencias) / duracion,
+        "p50_ms": percentil(latencias, 50) * 1000 if latencias else 0,
+        "p99_ms": percentil(latencias, 99) * 1000 if latencias else 0,
+        "errores": len(errores),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the rules API.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--clientes", type=int, default=32)
+    parser.add_argument("--duracion", type=float, default=20)
+    parser.add_argument("--escrituras", type=float, default=0.2, help="Fraction of write requests")
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'requests':>9} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for workers in args.workers:
+        r = ejecutar_caso(workers, args.threads, args.clientes, args.duracion, args.escrituras)
+        print(f"{r['workers']:>8} {r['peticiones']:>9} {r['rps']:>9.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['errores']:>7}")